@@ -0,0 +1,339 @@
+'''
+Command line batch runner for EmitterMovie jobs.
+
+    python batchRunner.py batchManifest.csv [--summary summary.csv] [--workers 4] [--memory-limit 8] [--time-limit 3600]
+                          [--force] [--profile] [--calibration-store calibration_profiles]
+
+A manifest lists jobs: an output emitter file, its colour, a parameter profile and the movies it is made from.
+CSV manifests have the columns output, colour, profile and movie, rows with the same output are one job whose
+movies are added in row order. Any EmitterMovie parameter (see emitterParameters.DEFAULT_PARAMETERS) can be given
+as an extra column, and memory_limit (GiB) and time_limit (CPU seconds) columns set the resource limits of a job.
+The memory limit covers allocated memory only, not memory-mapped movies (their pages are file cache).
+Frames of a job's movies are detected in chunks of chunk_frames frames (default 50) by a pool of workers processes
+(see proccessEmitters_getparams.process_movies), by default the cores are shared evenly by the jobs run at once.
+Resource limits apply to every process of a job. Jobs with a feature cache or workers 1 add their movies serially.
+A calibration column names the calibration profile of a job (e.g. Cheap_Objective_NA1.25/BO_605): a job uses the
+stored profile and skips calibration. Profiles which do not exist yet are calibrated once, on the movies of the
+first job naming them, and stored before the jobs run
+(see calibrationProfiles.CalibrationProfileStore, default store: calibration_profiles next to the manifest).
+Empty cells keep the profile value and lines starting with # are ignored.
+YAML manifests (needs PyYAML) have a jobs list with the same keys (movies is a list) and can define or
+override profiles in a profiles mapping.
+Relative movie and output paths are relative to the manifest.
+
+Jobs run in a process pool, one fresh process per job so resource limits apply per job. A job is skipped when its
+output is newer than its movies and was made with the same parameters and calibration profile (recorded in
+output + '.json'), use --force to run all jobs. A summary of acceptance ratios and timings is written as CSV or JSON.
+With --profile, time per processing stage and rejections per acceptance criterion of every job run are saved
+in output + '_profile.json' (see stageProfiler.StageProfiler).
+Jobs with a localisation column ('centroid' or 'gaussian') also save the sub-pixel positions, PSF widths and photons
+of their emitters in output + '_emitters.csv'.
+'''
+import argparse
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import csv
+import json
+import os
+import signal
+import time
+
+try:
+    import resource
+except ImportError: # no resource limits on Windows
+    resource = None
+
+from calibrationProfiles import CalibrationProfileStore
+from emitterParameters import DEFAULT_PARAMETERS, PROFILES
+from featureCache import FeatureCache
+from proccessEmitters_getparams import EmitterMovie, process_movies
+from stageProfiler import StageProfiler
+
+
+SUMMARY_FIELDS = ('output', 'colour', 'profile', 'movies', 'status', 'emitters', 'processed', 'acceptance_ratio',
+                  'frames_read', 'seconds', 'error')
+
+
+def _convert(name, value):
+    # Manifest text (CSV cells) converted to the type of the parameter.
+    if(not isinstance(value, str)):
+        return value
+    default = DEFAULT_PARAMETERS[name]
+    if(isinstance(default, bool)):
+        return value.strip().lower() in ('true', 'yes', '1')
+    if(isinstance(default, str) or name in ('feature_cache', 'localisation')):
+        return value
+    value = value.strip()
+    return int(value) if value.lstrip('-').isdigit() else float(value)
+
+
+def _job(directory, profiles, output, colour, profile, movies, settings):
+    # Job dict with the resolved EmitterMovie parameters of a manifest entry.
+    if(profile not in profiles):
+        raise ValueError("Unknown profile " + repr(profile) + " for " + output)
+    parameters = dict(DEFAULT_PARAMETERS, **profiles[profile])
+    options = {'memory_limit': None, 'time_limit': None, 'calibration': None, 'workers': None, 'chunk_frames': 50}
+    for name, value in settings.items():
+        if(value is None or value == ''):
+            continue
+        if(name == 'calibration'):
+            options[name] = str(value)
+        elif(name in ('workers', 'chunk_frames')):
+            options[name] = int(float(value))
+        elif(name in options):
+            options[name] = float(value)
+        elif(name in DEFAULT_PARAMETERS):
+            parameters[name] = _convert(name, value)
+        else:
+            raise ValueError("Unknown parameter " + repr(name) + " for " + output)
+    if(parameters['feature_cache'] is not None):
+        parameters['feature_cache'] = os.path.normpath(os.path.join(directory, parameters['feature_cache']))
+    return dict(options, output=os.path.normpath(os.path.join(directory, output)), colour=str(colour), profile=profile,
+                movies=[os.path.normpath(os.path.join(directory, path)) for path in movies], parameters=parameters)
+
+
+def read_manifest(path, calibration_store=None):
+    # List of jobs of a CSV or YAML manifest, calibration_store is the calibration profile directory of all jobs.
+    directory = os.path.dirname(os.path.abspath(path))
+    calibration_store = calibration_store or os.path.join(directory, 'calibration_profiles')
+    jobs = _read_jobs(path, directory)
+    for job in jobs:
+        job['calibration_store'] = calibration_store
+    return jobs
+
+
+def _read_jobs(path, directory):
+    if(path.endswith(('.yaml', '.yml'))):
+        import yaml # optional, only needed for YAML manifests
+        with open(path) as f:
+            manifest = yaml.safe_load(f)
+        profiles = dict(PROFILES, **manifest.get('profiles', {}))
+        jobs = []
+        for entry in manifest['jobs']:
+            entry = dict(entry)
+            movies = entry.pop('movies', None) or [entry.pop('movie')]
+            jobs.append(_job(directory, profiles, entry.pop('output'), entry.pop('colour'),
+                             entry.pop('profile', 'lp3'), movies, entry))
+        return jobs
+
+    with open(path, newline='') as f:
+        rows = list(csv.DictReader(line for line in f if not line.lstrip().startswith('#')))
+    entries = {} # output: (colour, profile, movies, settings), in manifest order
+    for row in rows:
+        row = {name: value.strip() for name, value in row.items() if value is not None}
+        output, movie = row.pop('output'), row.pop('movie')
+        colour, profile = row.pop('colour'), row.pop('profile', '') or 'lp3'
+        if(output in entries):
+            if(entries[output][:2] != (colour, profile) or entries[output][3] != row):
+                raise ValueError("Rows of " + output + " have different colours, profiles or parameters")
+            entries[output][2].append(movie)
+        else:
+            entries[output] = (colour, profile, [movie], row)
+    return [_job(directory, PROFILES, output, colour, profile, movies, settings)
+            for output, (colour, profile, movies, settings) in entries.items()]
+
+
+def _record_path(job):
+    return job['output'] + '.json'
+
+
+def _job_key(job):
+    # What makes an output out of date when it changes, as stored in the job record.
+    # The calibration profile is identified by its fingerprint, so saving it again makes its outputs out of date.
+    profile = None
+    if(job['calibration'] is not None):
+        profile = CalibrationProfileStore(job['calibration_store']).fingerprint(job['calibration'])
+    return json.loads(json.dumps({'colour': job['colour'], 'movies': job['movies'],
+                                  'parameters': job['parameters'], 'calibration': job['calibration'],
+                                  'calibration_profile': profile}))
+
+
+def up_to_date(job):
+    # True if the job's output is newer than its movies and was made with the same parameters and calibration profile.
+    record = _record_path(job)
+    if(not os.path.exists(job['output']) or not os.path.exists(record)):
+        return False
+    with open(record) as f:
+        if(json.load(f)['job'] != _job_key(job)):
+            return False
+    outputTime = os.path.getmtime(job['output'])
+    return all(os.path.exists(path) and os.path.getmtime(path) <= outputTime for path in job['movies'])
+
+
+def _cpu_time_exceeded(signum, frame):
+    raise TimeoutError("CPU time limit exceeded")
+
+
+def _limit_resources(memory_limit, time_limit):
+    # Resource limits of the current (job) process: memory in GiB and CPU time in seconds.
+    # Exceeding them raises MemoryError or TimeoutError in the job instead of killing the pool.
+    # Memory is limited with RLIMIT_DATA (allocated memory), not RLIMIT_AS: read-only memory-mapped movies
+    # take address space but are not counted, so movies of any size can still be mapped.
+    if(resource is None):
+        return
+    if(memory_limit is not None):
+        limit = int(memory_limit*1024**3)
+        resource.setrlimit(getattr(resource, 'RLIMIT_DATA', resource.RLIMIT_AS), (limit, limit))
+    if(time_limit is not None):
+        signal.signal(signal.SIGXCPU, _cpu_time_exceeded)
+        resource.setrlimit(resource.RLIMIT_CPU, (int(time_limit), resource.RLIM_INFINITY))
+
+
+def _summary_row(job, status, error=''):
+    return {'output': job['output'], 'colour': job['colour'], 'profile': job['profile'],
+            'movies': ';'.join(job['movies']), 'status': status, 'emitters': '', 'processed': '',
+            'acceptance_ratio': '', 'frames_read': '', 'seconds': '', 'error': error}
+
+
+def _job_movie(job, profile=False):
+    # EmitterMovie with the parameters of a job, using the job's calibration profile if it is stored.
+    parameters = dict(job['parameters'])
+    if(parameters['feature_cache'] is not None):
+        parameters['feature_cache'] = FeatureCache(parameters['feature_cache'])
+    movie = EmitterMovie(job['colour'], **parameters, profiler=StageProfiler() if profile else None)
+    store = CalibrationProfileStore(job['calibration_store'])
+    if(job['calibration'] is not None and job['calibration'] in store):
+        movie.load_calibration_profile(job['calibration'], store)
+    return movie
+
+
+def calibrate_job(job, memory_limit=None, time_limit=None):
+    # Calibrate on the movies of a job (until enough calibration emitters are found) and store the job's
+    # calibration profile, returns an error message or '' once the profile is stored.
+    try:
+        _limit_resources(job['memory_limit'] or memory_limit, job['time_limit'] or time_limit)
+        movie = _job_movie(job)
+        for path in job['movies']:
+            if(movie.test_emitter_list >= movie.test_emitter_list_length):
+                break
+            movie.get_parameters(path)
+        movie.save_calibration_profile(job['calibration'], CalibrationProfileStore(job['calibration_store']))
+    except Exception as error:
+        return type(error).__name__ + ": " + str(error)
+    return ''
+
+
+def run_job(job, memory_limit=None, time_limit=None, profile=False, workers=1):
+    # Detect and filter all movies of a job and save its emitter list, returns the job's summary row.
+    # Job limits and workers take precedence over the memory_limit, time_limit and workers defaults.
+    # Chunks of the movies are detected by workers processes, movies are added serially with one worker
+    # or a feature cache (which holds whole movies).
+    # With profile, the stage profile of the job is saved as output + '_profile.json'.
+    start = time.perf_counter()
+    try:
+        _limit_resources(job['memory_limit'] or memory_limit, job['time_limit'] or time_limit)
+        movie = _job_movie(job, profile)
+        store = CalibrationProfileStore(job['calibration_store'])
+        workers = job['workers'] or workers
+        if(workers > 1 and movie.feature_cache is None):
+            process_movies([(movie, path) for path in job['movies']], workers, job['chunk_frames'])
+        else:
+            for path in job['movies']:
+                movie.add_to_list(path)
+        if(job['calibration'] is not None and job['calibration'] not in store):
+            movie.save_calibration_profile(job['calibration'], store)
+        if(os.path.dirname(job['output'])):
+            os.makedirs(os.path.dirname(job['output']), exist_ok=True)
+        movie.save_emitter_list(job['output'])
+        if(movie.localisation is not None):
+            movie.save_emitter_table(job['output'] + '_emitters.csv')
+        if(profile):
+            movie.profiler.save(job['output'] + '_profile.json')
+    except Exception as error:
+        return _summary_row(job, 'failed', type(error).__name__ + ": " + str(error))
+
+    row = _summary_row(job, 'done')
+    row.update(emitters=movie.good_emitters_added, processed=movie.total_emitters_processed,
+               acceptance_ratio=movie.good_emitters_added/max(movie.total_emitters_processed, 1),
+               frames_read=movie.frames_read, seconds=round(time.perf_counter() - start, 3))
+    with open(_record_path(job), 'w') as f:
+        json.dump({'job': _job_key(job), 'result': row}, f, indent=1)
+    return row
+
+
+def write_summary(rows, path):
+    # Summary rows as JSON (.json) or CSV.
+    with open(path, 'w', newline='') as f:
+        if(path.endswith('.json')):
+            json.dump(rows, f, indent=1)
+        else:
+            writer = csv.DictWriter(f, fieldnames=SUMMARY_FIELDS)
+            writer.writeheader()
+            writer.writerows(rows)
+
+
+def run_manifest(path, summary=None, max_workers=None, memory_limit=None, time_limit=None, force=False,
+                 profile=False, calibration_store=None):
+    '''
+    Run all jobs of a manifest which are not up to date in a pool of max_workers processes (default: all cores)
+    and write the summary (default: the manifest name + _summary.csv). Returns the summary rows in manifest order.
+    Jobs without a workers setting detect their movies with an even share of all cores.
+    A failing job (error, memory or time limit) is reported in the summary and does not stop the other jobs.
+    '''
+    jobs = read_manifest(path, calibration_store)
+    rows = {}
+    pending = []
+    for index, job in enumerate(jobs):
+        if(not force and up_to_date(job)):
+            with open(_record_path(job)) as f:
+                rows[index] = dict(json.load(f)['result'], status='skipped')
+        else:
+            pending.append(index)
+    print("Jobs:", len(jobs), "to run:", len(pending), "up to date:", len(jobs) - len(pending))
+
+    if(pending):
+        max_workers = max_workers or os.cpu_count()
+        jobWorkers = max(1, os.cpu_count()//min(max_workers, len(pending))) # detection processes per job
+        with ProcessPoolExecutor(max_workers=max_workers, max_tasks_per_child=1) as executor:
+            # Missing calibration profiles are made once, by the first job naming them, before any job uses them.
+            missing = {}
+            for index in pending:
+                job = jobs[index]
+                if(job['calibration'] is not None and job['calibration'] not in missing
+                   and job['calibration'] not in CalibrationProfileStore(job['calibration_store'])):
+                    missing[job['calibration']] = executor.submit(calibrate_job, job, memory_limit, time_limit)
+            errors = {}
+            for name, future in missing.items():
+                try:
+                    errors[name] = future.result()
+                except Exception as error: # worker process killed
+                    errors[name] = type(error).__name__ + ": " + str(error)
+                print("failed" if errors[name] else "calibrated", name, errors[name])
+            futures = {}
+            for index in pending:
+                error = errors.get(jobs[index]['calibration'])
+                if(error):
+                    rows[index] = _summary_row(jobs[index], 'failed', "Calibration failed: " + error)
+                    print(rows[index]['status'], rows[index]['output'], rows[index]['error'])
+                else:
+                    futures[executor.submit(run_job, jobs[index], memory_limit, time_limit, profile, jobWorkers)] = index
+            for future in as_completed(futures):
+                index = futures[future]
+                try:
+                    rows[index] = future.result()
+                except Exception as error: # worker process killed
+                    rows[index] = _summary_row(jobs[index], 'failed', type(error).__name__ + ": " + str(error))
+                print(rows[index]['status'], rows[index]['output'], rows[index]['error'])
+
+    rows = [rows[index] for index in range(len(jobs))]
+    write_summary(rows, summary or os.path.splitext(path)[0] + '_summary.csv')
+    return rows
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Make single emitter files for the movies of a manifest.")
+    parser.add_argument('manifest', help="CSV or YAML manifest of jobs")
+    parser.add_argument('--summary', help="summary file (.csv or .json)")
+    parser.add_argument('--workers', type=int, help="amount of jobs run at once (default: all cores)")
+    parser.add_argument('--memory-limit', type=float, help="default memory limit of a job in GiB")
+    parser.add_argument('--time-limit', type=float, help="default CPU time limit of a job in seconds")
+    parser.add_argument('--force', action='store_true', help="also run jobs which are up to date")
+    parser.add_argument('--profile', action='store_true', help="save a stage profile of every job run")
+    parser.add_argument('--calibration-store', help="calibration profile directory (default: next to the manifest)")
+    args = parser.parse_args(argv)
+    rows = run_manifest(args.manifest, args.summary, args.workers, args.memory_limit, args.time_limit, args.force,
+                        args.profile, args.calibration_store)
+    return 1 if any(row['status'] == 'failed' for row in rows) else 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
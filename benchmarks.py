@@ -0,0 +1,265 @@
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+
+# Cold start budgets in seconds (interpreter start included) of the processing entry points.
+IMPORT_BUDGETS = {'proccessEmitters_getparams': 1.0, 'scaleEmitters': 0.5, 'datavisualise': 0.5}
+
+# (frames, frame size) of the synthetic movies of the pipeline benchmark.
+PIPELINE_SIZES = ((200, 128), (200, 256), (100, 512))
+
+
+def _time(function, *args, repeats=3, **kwargs):
+    # Best wall time of repeats calls, and the result of the last call.
+    best = np.inf
+    for _ in range(repeats):
+        start = time.perf_counter()
+        result = function(*args, **kwargs)
+        best = min(best, time.perf_counter() - start)
+    return best, result
+
+
+def benchmark_normalisation(frames=100000, size=9, seed=0):
+    # Time the per frame 2-norm loop of scaledEmitterMovie against the batched normalisation modes
+    # on a random (frames, size, size) emitter stack, and report the difference of the spectral modes to the
+    # per frame output (the other modes are different normalisations).
+    from scaleEmitters import NORMALISATION_MODES, normalize_frames, scaledEmitterMovie
+
+    stack = np.random.default_rng(seed).integers(400, 4000, (frames, size, size)).astype(np.uint16)
+    movie = scaledEmitterMovie(frames)
+
+    def per_frame(stack):
+        return np.array([movie.normalize_2d(singleFrame - singleFrame.mean()) for singleFrame in stack])
+
+    reference_time, reference = _time(per_frame, stack, repeats=1)
+    print(f"{'per frame spectral (loop)':28s} {reference_time:8.3f} s {frames/reference_time:12.0f} frames/s")
+    results = {'per_frame': reference_time}
+    for mode in NORMALISATION_MODES:
+        for method in (('svd', 'eigh') if mode == 'spectral' else ('svd',)):
+            elapsed, scaled = _time(normalize_frames, stack, mode, method)
+            name = mode + (' (' + method + ')' if mode == 'spectral' else '')
+            difference = f"   max difference {np.max(np.abs(scaled - reference)):.2e}" if mode == 'spectral' else ""
+            print(f"{name:28s} {elapsed:8.3f} s {frames/elapsed:12.0f} frames/s" + difference)
+            results[name] = elapsed
+    return results
+
+
+def benchmark_import_time(budgets=IMPORT_BUDGETS, repeats=5):
+    # Cold start time of importing every module of budgets in a fresh interpreter (best of repeats),
+    # compared with its budget. Returns {module: seconds} and whether all modules are within budget.
+    directory = os.path.dirname(os.path.abspath(__file__))
+    times = {}
+    for module, budget in budgets.items():
+        best = np.inf
+        for _ in range(repeats):
+            start = time.perf_counter()
+            subprocess.run([sys.executable, '-c', 'import ' + module], cwd=directory, check=True)
+            best = min(best, time.perf_counter() - start)
+        times[module] = best
+        print(f"{module:28s} {best:8.3f} s   budget {budget:.3f} s   {'ok' if best <= budget else 'OVER BUDGET'}")
+    return times, all(times[module] <= budget for module, budget in budgets.items())
+
+
+def _peak_rss():
+    # Peak resident set size of this process in MB (ru_maxrss is in KiB on Linux and bytes on macOS).
+    import resource
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak/1024**2 if sys.platform == 'darwin' else peak/1024
+
+
+def _pipeline_case(frames, size, directory, seed):
+    # One pipeline benchmark case, run in its own process so peak RSS belongs to this case only.
+    os.environ.setdefault('MPLBACKEND', 'Agg') # visualise_emitter_parameters without a display
+    from datavisualise import visualise_emitter_parameters
+    from proccessEmitters_getparams import EmitterMovie
+    from scaleEmitters import scaledEmitterMovie
+    from syntheticMovies import write_synthetic_movie
+
+    moviePath = os.path.join(directory, f"movie_{frames}x{size}.tif")
+    emitterPath = os.path.join(directory, f"emitters_{frames}x{size}.tif")
+    write_synthetic_movie(moviePath, frames, size, seed=seed)
+    movie = EmitterMovie("bench", 0.01, 3, 4, 20, 10**7, 1000, 3, False, 0, 0, 0, 0, 0, 0, 0, 0)
+    stages = {}
+
+    def timed(name, function, *args):
+        start = time.perf_counter()
+        function(*args)
+        stages[name] = {'seconds': time.perf_counter() - start}
+
+    timed('get_parameters', movie.get_parameters, moviePath)
+    stages['get_parameters'].update(frames=movie.frames_read, rois=movie.test_emitter_list)
+    movie.use_input_parameter_vals = True # add_to_list only filters, with the inferred acceptance ranges
+    framesRead = movie.frames_read
+    timed('add_to_list', movie.add_to_list, moviePath)
+    stages['add_to_list'].update(frames=movie.frames_read - framesRead, rois=movie.total_emitters_processed)
+    emitters = len(movie.movie_emitter_list)
+    timed('save_emitter_list', movie.save_emitter_list, emitterPath)
+    scaled = scaledEmitterMovie(emitters)
+    scaled.add_to_movie(emitterPath)
+    timed('save_movie', scaled.save_movie, os.path.join(directory, f"scaled_{frames}x{size}.tif"))
+    # Plotting libraries are imported lazily by the first call, import them first so only stats and plots are timed.
+    import matplotlib.pyplot
+    import skimage.io
+    timed('visualise_emitter_parameters', visualise_emitter_parameters, 4, emitterPath)
+    for name in ('save_emitter_list', 'save_movie', 'visualise_emitter_parameters'):
+        stages[name].update(frames=emitters, rois=emitters)
+
+    for stage in stages.values():
+        stage['frames_per_s'] = stage['frames']/stage['seconds']
+        stage['rois_per_s'] = stage['rois']/stage['seconds']
+    return {'frames': frames, 'size': size, 'emitters': emitters, 'peak_rss_mb': _peak_rss(), 'stages': stages}
+
+
+def benchmark_pipeline(sizes=PIPELINE_SIZES, seed=0):
+    '''
+    Time the processing entry points on synthetic movies (see syntheticMovies) of every (frames, frame size) in sizes:
+    EmitterMovie.get_parameters, add_to_list (filtering only), save_emitter_list, scaledEmitterMovie.save_movie
+    and visualise_emitter_parameters of the saved emitters (without importing the plotting libraries).
+    Frames/s count movie frames read for the first two stages and emitter frames for the others, ROIs/s count
+    candidate ROIs (calibration emitters for get_parameters). Every case runs in a fresh process for its peak RSS.
+    Returns {case: {'frames', 'size', 'emitters', 'peak_rss_mb', 'stages': {stage: {'seconds', 'frames', 'rois',
+    'frames_per_s', 'rois_per_s'}}}} with cases named framesxsize.
+    '''
+    results = {}
+    with tempfile.TemporaryDirectory() as directory:
+        for frames, size in sizes:
+            with ProcessPoolExecutor(max_workers=1) as executor:
+                result = executor.submit(_pipeline_case, frames, size, directory, seed).result()
+            results[f"{frames}x{size}"] = result
+            print(f"\n{frames} frames of {size}x{size}: {result['emitters']} emitters, "
+                  f"peak RSS {result['peak_rss_mb']:.0f} MB")
+            for name, stage in result['stages'].items():
+                print(f"{name:28s} {stage['seconds']:8.3f} s {stage['frames_per_s']:12.0f} frames/s "
+                      f"{stage['rois_per_s']:12.0f} ROIs/s")
+    return results
+
+
+def _labelled_rois(count, size=9, seed=0):
+    # Normalised (count, size, size) ROIs of narrow (label 0) and wide (label 1) Gaussian PSFs at random sub-pixel
+    # positions with background and shot noise, labelled data for benchmark_classifier_parity.
+    from scaleEmitters import normalize_frames
+
+    rng = np.random.default_rng(seed)
+    labels = rng.integers(0, 2, count)
+    sigma = np.where(labels == 0, 1.2, 1.4)[:, np.newaxis, np.newaxis]
+    pixels = np.arange(size) - size//2
+    y = pixels[:, np.newaxis] - rng.uniform(-0.5, 0.5, (count, 1, 1))
+    x = pixels - rng.uniform(-0.5, 0.5, (count, 1, 1))
+    amplitude = rng.uniform(800, 3000, (count, 1, 1))
+    rois = rng.poisson(100 + amplitude*np.exp(-0.5*(y**2 + x**2)/sigma**2)).astype(float)
+    return normalize_frames(rois).astype(np.float32), labels
+
+
+def benchmark_classifier_parity(model=None, dataset=None, count=20000, epochs=3, seed=0):
+    '''
+    Accuracy parity of the numpyClassifier export of a Keras classifier for every weight type
+    (see numpyClassifier.parity_check), and prediction ROIs/s of the Keras model and the exports.
+    model is a saved Keras model and dataset a packed dataset (see packedDataset) whose frames and labels are checked.
+    Without a model, a small classifier like those of the notebooks (Dense layers per pixel, Flatten, softmax)
+    is trained for epochs epochs on count synthetic ROIs of narrow and wide PSFs, and checked on count other ROIs
+    unless a dataset is given. Needs TensorFlow.
+    Returns {weights: parity_check result with 'keras_rois_per_s' and 'numpy_rois_per_s'} and whether all passed.
+    '''
+    import tensorflow as tf # optional, only needed for this benchmark
+    from numpyClassifier import WEIGHT_TYPES, NumpyClassifier, export_model, parity_check
+
+    if(dataset is not None):
+        from packedDataset import PackedDataset
+        packed = PackedDataset(dataset)
+        rois, labels = packed.take(np.arange(len(packed)))
+    else:
+        rois, labels = _labelled_rois(count, seed=seed)
+    if(model is None):
+        tf.keras.utils.set_random_seed(seed)
+        model = tf.keras.Sequential([tf.keras.Input(rois.shape[1:] + (1,)),
+                                     tf.keras.layers.Dense(32, activation='relu'),
+                                     tf.keras.layers.Dense(16, activation='relu'),
+                                     tf.keras.layers.Flatten(),
+                                     tf.keras.layers.Dense(int(labels.max()) + 1, activation='softmax')])
+        model.compile(optimizer='adam', loss='sparse_categorical_crossentropy')
+        trainRois, trainLabels = _labelled_rois(count, rois.shape[1], seed + 1)
+        model.fit(trainRois[..., np.newaxis], trainLabels, batch_size=64, epochs=epochs, verbose=0)
+    else:
+        model = tf.keras.models.load_model(model)
+
+    kerasTime, _ = _time(model.predict, rois.reshape((-1,) + tuple(model.input_shape[1:])), repeats=1, verbose=0)
+    results = {}
+    with tempfile.TemporaryDirectory() as directory:
+        for weights in WEIGHT_TYPES:
+            path = os.path.join(directory, weights + '.npz')
+            export_model(model, path, weights=weights)
+            classifier = NumpyClassifier(path)
+            result = parity_check(model, classifier, rois, 1e-4 if weights == 'float32' else 1e-2, labels)
+            numpyTime, _ = _time(classifier.predict, rois)
+            result.update(keras_rois_per_s=len(rois)/kerasTime, numpy_rois_per_s=len(rois)/numpyTime)
+            results[weights] = result
+            print(f"{weights:8s} max difference {result['max_difference']:.2e}   class agreement "
+                  f"{result['class_agreement']:.4f}   accuracy Keras {result['keras_accuracy']:.4f} NumPy "
+                  f"{result['numpy_accuracy']:.4f}   {result['numpy_rois_per_s']:12.0f} ROIs/s (Keras "
+                  f"{result['keras_rois_per_s']:.0f})   {'ok' if result['passed'] else 'FAILED'}")
+    return results, all(result['passed'] for result in results.values())
+
+
+def compare_to_baseline(results, baseline, tolerance=0.25, slack=0.01):
+    # Regressions of benchmark_pipeline results against a stored baseline: stages slower than the
+    # baseline by more than tolerance (a fraction) plus slack seconds (timer noise of very short stages)
+    # and cases with a larger peak RSS. Cases missing from the baseline are not compared.
+    # Returns a list of messages, empty if there are no regressions.
+    regressions = []
+    for case, result in results.items():
+        if(case not in baseline):
+            continue
+        for name, stage in result['stages'].items():
+            reference = baseline[case]['stages'].get(name)
+            if(reference is not None and stage['seconds'] > reference['seconds']*(1 + tolerance) + slack):
+                regressions.append(f"{case} {name}: {stage['seconds']:.3f} s, baseline {reference['seconds']:.3f} s")
+        if(result['peak_rss_mb'] > baseline[case]['peak_rss_mb']*(1 + tolerance)):
+            regressions.append(f"{case} peak RSS: {result['peak_rss_mb']:.0f} MB, "
+                               f"baseline {baseline[case]['peak_rss_mb']:.0f} MB")
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Processing benchmarks.")
+    commands = parser.add_subparsers(dest='command', required=True)
+    normalisation = commands.add_parser('normalisation', help="per frame normalisation modes")
+    normalisation.add_argument('--frames', type=int, default=100000)
+    commands.add_parser('imports', help="cold start time of the processing entry points")
+    pipeline = commands.add_parser('pipeline', help="processing entry points on synthetic movies")
+    pipeline.add_argument('--sizes', nargs='+', default=[f"{frames}x{size}" for frames, size in PIPELINE_SIZES],
+                          help="framesxsize of each synthetic movie, e.g. 200x256")
+    pipeline.add_argument('--baseline', help="JSON results to compare with, regressions give exit status 1")
+    pipeline.add_argument('--tolerance', type=float, default=0.25, help="allowed slowdown as a fraction")
+    pipeline.add_argument('--save', help="save results as JSON (e.g. a new baseline)")
+    parity = commands.add_parser('parity', help="accuracy parity of exported classifiers with the Keras model")
+    parity.add_argument('--model', help="saved Keras model (default: a small classifier trained on synthetic ROIs)")
+    parity.add_argument('--dataset', help="packed dataset whose frames and labels are checked")
+    parity.add_argument('--rois', type=int, default=20000, help="synthetic ROIs for training and for the check")
+    args = parser.parse_args()
+
+    if(args.command == 'normalisation'):
+        benchmark_normalisation(args.frames)
+    elif(args.command == 'imports'):
+        _, withinBudget = benchmark_import_time()
+        sys.exit(0 if withinBudget else 1)
+    elif(args.command == 'pipeline'):
+        results = benchmark_pipeline([tuple(int(n) for n in size.split('x')) for size in args.sizes])
+        if(args.save):
+            with open(args.save, 'w') as f:
+                json.dump(results, f, indent=1)
+        if(args.baseline):
+            with open(args.baseline) as f:
+                regressions = compare_to_baseline(results, json.load(f), args.tolerance)
+            print("\nRegressions:" if regressions else "\nNo regressions", *regressions, sep="\n")
+            sys.exit(1 if regressions else 0)
+    elif(args.command == 'parity'):
+        _, passed = benchmark_classifier_parity(args.model, args.dataset, args.rois)
+        sys.exit(0 if passed else 1)
@@ -0,0 +1,99 @@
+from contextlib import contextmanager
+from datetime import datetime, timezone
+import hashlib
+import json
+import os
+import re
+
+from calibrationStats import CalibrationStats
+
+
+# Acceptance parameters of a profile, in EmitterMovie attribute names.
+PROFILE_PARAMETERS = ('xinvmag_mean', 'xinvmag_stddev', 'yinvmag_mean', 'yinvmag_stddev', 'ellipticity_mean',
+                      'ellipticity_stddev', 'IntensityRange_median', 'IntensityRange_stddev')
+# EmitterMovie settings which change the calibration features, stored with a profile and checked when loading.
+PROFILE_SETTINGS = ('GaussianFiltersigma1', 'GaussianFiltersigma2', 'ROIradius', 'BorderRegion',
+                    'edge_peak_threshold_value', 'edge_value_multiplier')
+
+
+class CalibrationProfileStore:
+    '''
+    Local store of named calibration profiles, e.g. one per objective, colour and filter setup
+    ("Cheap_Objective_NA1.25/BO_605"), so new acquisitions with the same setup can skip calibration.
+    index.json in directory lists every profile with its acceptance parameters, the settings it was made with
+    and its provenance: source movies with their amount of calibration emitters, total count and creation date.
+    The calibration statistics of a profile are stored next to the index, so a profile can be extended later.
+    Saving a profile under an existing name replaces it. Updates of the index are locked where fcntl is available.
+    '''
+    def __init__(self, directory='calibration_profiles'):
+        self.directory = directory
+
+    @property
+    def index_path(self):
+        return os.path.join(self.directory, 'index.json')
+
+    def index(self):
+        if(not os.path.exists(self.index_path)):
+            return {}
+        with open(self.index_path) as f:
+            return json.load(f)
+
+    def names(self):
+        return sorted(self.index())
+
+    def __contains__(self, name):
+        return name in self.index()
+
+    def fingerprint(self, name):
+        # Hash of a profile's index entry (parameters, statistics count, sources and creation date), which changes
+        # whenever the profile is saved again, or None if there is no such profile.
+        entry = self.index().get(name)
+        if(entry is None):
+            return None
+        return hashlib.sha1(json.dumps(entry, sort_keys=True).encode()).hexdigest()
+
+    @contextmanager
+    def _locked(self):
+        os.makedirs(self.directory, exist_ok=True)
+        with open(os.path.join(self.directory, '.lock'), 'w') as lock:
+            try:
+                import fcntl
+                fcntl.flock(lock, fcntl.LOCK_EX)
+            except ImportError: # no file locking on Windows
+                pass
+            yield
+
+    def _write_json(self, path, data):
+        temporary = path + '.tmp'
+        with open(temporary, 'w') as f:
+            json.dump(data, f, indent=1)
+        os.replace(temporary, path)
+
+    def save(self, name, parameters, settings, calibration_stats, sources):
+        # Store a profile: parameters and settings are dicts (see PROFILE_PARAMETERS and PROFILE_SETTINGS),
+        # sources a list of {'movie': path, 'emitters': amount} dicts.
+        statsFile = re.sub(r'[^A-Za-z0-9_.-]', '_', name) + '_' + hashlib.sha1(name.encode()).hexdigest()[:8] + '.json'
+        entry = {'parameters': {key: float(value) for key, value in parameters.items()},
+                 'settings': settings, 'count': calibration_stats.count, 'sources': sources,
+                 'created': datetime.now(timezone.utc).isoformat(timespec='seconds'), 'stats': statsFile}
+        with self._locked():
+            calibration_stats.save(os.path.join(self.directory, statsFile))
+            index = self.index()
+            index[name] = entry
+            self._write_json(self.index_path, index)
+        return entry
+
+    def load(self, name):
+        # (index entry, CalibrationStats) of a profile.
+        index = self.index()
+        if(name not in index):
+            raise KeyError("No calibration profile " + repr(name) + " in " + self.directory)
+        entry = index[name]
+        return entry, CalibrationStats.load(os.path.join(self.directory, entry['stats']))
+
+    def remove(self, name):
+        with self._locked():
+            index = self.index()
+            entry = index.pop(name)
+            self._write_json(self.index_path, index)
+            os.remove(os.path.join(self.directory, entry['stats']))
@@ -0,0 +1,163 @@
+import json
+
+import numpy as np
+
+
+class RunningStats:
+    '''
+    Mean and standard deviation of a stream of values, updated batch by batch
+    (Welford's algorithm with Chan's update for batches), without keeping the values.
+    The first batch gives exactly np.mean and np.std of that batch, later batches and merges agree
+    with np.mean and np.std of all values up to rounding.
+    '''
+    def __init__(self, count=0, mean=0.0, m2=0.0):
+        self.count = count
+        self.mean = mean
+        self.m2 = m2 # sum of squared differences from the mean
+
+    def _combine(self, count, mean, m2):
+        if(count == 0):
+            return
+        if(self.count == 0):
+            self.count, self.mean, self.m2 = count, mean, m2
+            return
+        total = self.count + count
+        delta = mean - self.mean
+        self.mean = self.mean + delta*count/total
+        self.m2 = self.m2 + m2 + delta**2*self.count*count/total
+        self.count = total
+
+    def update(self, values):
+        values = np.asarray(values, dtype=float).ravel()
+        if(len(values)):
+            mean = np.mean(values)
+            self._combine(len(values), mean, np.sum((values - mean)**2))
+
+    def merge(self, other):
+        self._combine(other.count, other.mean, other.m2)
+
+    def std(self):
+        return np.sqrt(self.m2/self.count) if self.count else np.nan
+
+    def state(self):
+        return {'count': self.count, 'mean': float(self.mean), 'm2': float(self.m2)}
+
+
+class QuantileSketch:
+    '''
+    Mergeable streaming quantile sketch (a deterministic KLL style compactor stack) with bounded memory.
+    Values are kept exactly until there are more than k of them, so quantiles are exact (the same as np.median
+    and np.quantile) for up to k values. After that, a full level is sorted and every other value moves up a level
+    with twice the weight, which keeps about k*log2(n/k) values and a rank error of the order of log2(n/k)/k.
+    '''
+    def __init__(self, k=4096):
+        self.k = k
+        self.levels = [np.zeros(0)] # values of level h have weight 2**h
+        self.offsets = [0] # alternating compaction offset of every level
+
+    @property
+    def count(self):
+        return int(sum(len(values) << level for level, values in enumerate(self.levels)))
+
+    def _compact(self):
+        level = 0
+        while(level < len(self.levels)):
+            if(len(self.levels[level]) > self.k):
+                values = np.sort(self.levels[level])
+                kept = values[len(values) - len(values) % 2:] # an odd value out stays on this level
+                values = values[:len(values) - len(values) % 2]
+                if(level + 1 == len(self.levels)):
+                    self.levels.append(np.zeros(0))
+                    self.offsets.append(0)
+                self.levels[level + 1] = np.concatenate((self.levels[level + 1], values[self.offsets[level]::2]))
+                self.offsets[level] = 1 - self.offsets[level]
+                self.levels[level] = kept
+            level += 1
+
+    def update(self, values):
+        self.levels[0] = np.concatenate((self.levels[0], np.asarray(values, dtype=float).ravel()))
+        self._compact()
+
+    def merge(self, other):
+        for level, values in enumerate(other.levels):
+            if(level == len(self.levels)):
+                self.levels.append(np.zeros(0))
+                self.offsets.append(other.offsets[level])
+            self.levels[level] = np.concatenate((self.levels[level], values))
+        self._compact()
+
+    def quantile(self, q):
+        if(self.count == 0):
+            return np.nan
+        if(len(self.levels) == 1):
+            return np.quantile(self.levels[0], q)
+        values = np.concatenate(self.levels)
+        weights = np.concatenate([np.full(len(values), 2**level) for level, values in enumerate(self.levels)])
+        order = np.argsort(values, kind='stable')
+        cumulative = np.cumsum(weights[order])
+        return values[order][np.searchsorted(cumulative, q*cumulative[-1])]
+
+    def median(self):
+        return self.quantile(0.5)
+
+    def state(self):
+        return {'k': self.k, 'levels': [values.tolist() for values in self.levels], 'offsets': list(self.offsets)}
+
+    @classmethod
+    def from_state(cls, state):
+        sketch = cls(state['k'])
+        sketch.levels = [np.asarray(values, dtype=float) for values in state['levels']]
+        sketch.offsets = list(state['offsets'])
+        return sketch
+
+
+class CalibrationStats:
+    '''
+    Streaming calibration statistics of EmitterMovie: median (a QuantileSketch) and standard deviation of the
+    mean intensity, and mean and standard deviation of the x,y inverse Fourier magnitudes and ellipticity
+    of calibration emitters. Update with feature table rows (see emitterFeatures.FEATURE_DTYPE) as they are
+    found, memory does not grow with the amount of calibration emitters.
+    Statistics of several movies, chunks or parallel workers are combined with merge,
+    and can be saved to and loaded from JSON files.
+    '''
+    FIELDS = ('mean_intensity', 'xinvmag', 'yinvmag', 'ellipticity')
+
+    def __init__(self, k=4096):
+        self.stats = {name: RunningStats() for name in self.FIELDS}
+        self.intensity_sketch = QuantileSketch(k)
+
+    @property
+    def count(self):
+        return self.stats['mean_intensity'].count
+
+    def update(self, features):
+        for name in self.FIELDS:
+            self.stats[name].update(features[name])
+        self.intensity_sketch.update(features['mean_intensity'])
+
+    def merge(self, other):
+        for name in self.FIELDS:
+            self.stats[name].merge(other.stats[name])
+        self.intensity_sketch.merge(other.intensity_sketch)
+
+    def parameters(self):
+        # Acceptance range centres and widths in the order of the EmitterMovie arguments:
+        # x,y inverse Fourier magnitude and ellipticity mean and stddev, intensity median and stddev.
+        return (self.stats['xinvmag'].mean if self.count else np.nan, self.stats['xinvmag'].std(),
+                self.stats['yinvmag'].mean if self.count else np.nan, self.stats['yinvmag'].std(),
+                self.stats['ellipticity'].mean if self.count else np.nan, self.stats['ellipticity'].std(),
+                self.intensity_sketch.median(), self.stats['mean_intensity'].std())
+
+    def save(self, path):
+        with open(path, 'w') as f:
+            json.dump({'stats': {name: stats.state() for name, stats in self.stats.items()},
+                       'intensity_sketch': self.intensity_sketch.state()}, f)
+
+    @classmethod
+    def load(cls, path):
+        with open(path) as f:
+            state = json.load(f)
+        calibration = cls()
+        calibration.stats = {name: RunningStats(**stats) for name, stats in state['stats'].items()}
+        calibration.intensity_sketch = QuantileSketch.from_state(state['intensity_sketch'])
+        return calibration
@@ -0,0 +1,114 @@
+'''
+Batch colour classification of the emitters of raw movies with a trained classifier.
+
+    python classifyEmitters.py colour_classifier.keras movie.tif emitters.csv --classes 605 655 [--calibration NAME]
+    python classifyEmitters.py colour_classifier.npz movie.tif emitters.csv [--calibration NAME]
+
+Models exported by numpyClassifier (.npz) are used without TensorFlow and know their class names.
+
+The movie is opened once and its frames are detected in chunks by EmitterMovie (same detection, ROI features and
+acceptance ranges as for the training data) in a thread pool, uncalibrated movies are calibrated from the first
+chunks. Accepted ROIs are normalised like scaleEmitters does and classified in large batches while the next
+chunks are detected, so throughput is bounded by the slower of detection and prediction.
+The output CSV has one row per emitter: frame, y, x, predicted colour and confidence (its class probability).
+'''
+import argparse
+import csv
+
+import numpy as np
+
+from calibrationProfiles import CalibrationProfileStore
+from emitterParameters import DEFAULT_PARAMETERS, PROFILES
+from movieReader import TiffMovieReader
+from numpyClassifier import NumpyClassifier, class_confidences
+from proccessEmitters_getparams import EmitterMovie, calibrated_chunks, detect_chunks
+from scaleEmitters import normalize_frames
+
+
+OUTPUT_FIELDS = ('frame', 'y', 'x', 'colour', 'confidence')
+
+
+def keras_predictor(path, batch_size=4096):
+    # Class probabilities of a (N, h, w) ROI stack from a saved Keras model.
+    import tensorflow as tf # optional, only needed for Keras models
+    model = tf.keras.models.load_model(path)
+    channels = len(model.input_shape) == 4 # models with an (h, w, 1) input
+
+    def predict(rois):
+        return model.predict(rois[..., np.newaxis] if channels else rois, batch_size=batch_size, verbose=0)
+    return predict
+
+
+def load_predictor(path, batch_size=4096):
+    # (predict, class names or None) of a saved Keras model or an exported numpyClassifier model (.npz).
+    if(path.endswith('.npz')):
+        classifier = NumpyClassifier(path)
+        return classifier.predict, classifier.class_names
+    return keras_predictor(path, batch_size), None
+
+
+def classify_movie(path, predict, class_names, movie, output, accepted_only=True, batch_size=4096,
+                   chunk_frames=32, workers=None, normalisation='spectral'):
+    '''
+    Classify the emitters of a movie and write them to the output CSV, returns {colour: amount of emitters}.
+    predict maps a float32 (N, h, w) stack of normalised ROIs to class probabilities (e.g. keras_predictor).
+    movie is the EmitterMovie used for detection: without acceptance ranges (use_input_parameter_vals False)
+    the first chunks are held back until they calibrate the movie, see proccessEmitters_getparams.calibrated_chunks.
+    accepted_only classifies only ROIs within the acceptance ranges, otherwise every candidate which passes the
+    edge and single peak checks.
+    The movie is opened once, chunks of chunk_frames frames are detected by workers threads (default: all cores)
+    ahead of prediction (see proccessEmitters_getparams.detect_chunks), ROIs are classified batch_size at a time.
+    '''
+    counts = dict.fromkeys(class_names, 0)
+    heldFeatures, heldRois, held = [], [], 0
+
+    def classify(features, rois):
+        classes, confidences = class_confidences(predict(normalize_frames(rois, normalisation).astype(np.float32)))
+        for row, colour, confidence in zip(features, classes, confidences):
+            writer.writerow((row['frame'], row['y'], row['x'], class_names[colour], f"{confidence:.6f}"))
+            counts[class_names[colour]] += 1
+
+    with TiffMovieReader(path) as reader, open(output, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(OUTPUT_FIELDS)
+        chunks = detect_chunks(movie, reader, chunk_frames, workers)
+        for features, rois in calibrated_chunks(movie, chunks, len(reader), path):
+            keep = movie.acceptance_mask(features) if accepted_only else features['edge_ok'] & features['single_peak']
+            heldFeatures.append(features[keep])
+            heldRois.append(rois[keep])
+            held += np.count_nonzero(keep)
+            if(held >= batch_size):
+                classify(np.concatenate(heldFeatures), np.concatenate(heldRois))
+                heldFeatures, heldRois, held = [], [], 0
+        if(held):
+            classify(np.concatenate(heldFeatures), np.concatenate(heldRois))
+    return counts
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Classify the emitters of raw movies with a trained colour classifier.")
+    parser.add_argument('model', help="saved Keras model or exported numpyClassifier model (.npz)")
+    parser.add_argument('movie', help="raw Tiff movie")
+    parser.add_argument('output', help="output CSV, one row per emitter")
+    parser.add_argument('--classes', nargs='+', help="colour names in label order (default: those of a .npz model)")
+    parser.add_argument('--profile', default='lp3', choices=sorted(PROFILES), help="EmitterMovie parameter profile")
+    parser.add_argument('--calibration', help="calibration profile name, the movie is calibrated if not given")
+    parser.add_argument('--calibration-store', default='calibration_profiles', help="calibration profile directory")
+    parser.add_argument('--all-candidates', action='store_true',
+                        help="classify all single peak candidates, not only those within the acceptance ranges")
+    parser.add_argument('--batch-size', type=int, default=4096)
+    parser.add_argument('--chunk-frames', type=int, default=32)
+    parser.add_argument('--workers', type=int, help="detection threads (default: all cores)")
+    args = parser.parse_args()
+
+    predict, classes = load_predictor(args.model, args.batch_size)
+    classes = args.classes or classes
+    if(not classes):
+        parser.error("--classes is required for models without class names")
+    movie = EmitterMovie(classes[0], **dict(DEFAULT_PARAMETERS, **PROFILES[args.profile]))
+    if(args.calibration):
+        movie.load_calibration_profile(args.calibration, CalibrationProfileStore(args.calibration_store))
+    counts = classify_movie(args.movie, predict, classes, movie, args.output,
+                            not args.all_candidates, args.batch_size, args.chunk_frames, args.workers)
+    for colour, count in counts.items():
+        print(colour, count, "emitters")
@@ -1,144 +1,77 @@
-import matplotlib.pyplot as plt
 import numpy as np
-import skimage.io
+
+from emitterFeatures import inverse_fourier_magnitudes
+
+# Parameter, plot title, height of the acceptance range lines and histogram bins of values below, within and
+# above the acceptance range (None: not plotted).
+PLOT_SETTINGS = [('xinvmag', "x inverse F. mag", 120, (None, 9, 9)),
+                 ('yinvmag', "y inverse F. mag", 180, (4, 6, 8)),
+                 ('ellipticity', "ellipticity", 220, (8, 6, 8)),
+                 ('mean_intensity', "mean intensity counts", 100, (4, 8, 6))]
+
+
+def emitter_parameter_stats(imageset, ROIradius):
+    '''
+    Parameters of every emitter frame of a (N, 2*ROIradius+1, 2*ROIradius+1) stack and their acceptance ranges,
+    computed in one batch, without matplotlib.
+    Returns a dict with 'max_intensity' (maximum of every frame) and for 'xinvmag', 'yinvmag', 'ellipticity'
+    and 'mean_intensity' a dict with the per frame 'values', 'centre' (mean, median for mean intensity),
+    'stddev', range 'lower' and 'upper' bounds (centre -/+ stddev) and boolean masks 'below', 'good' and 'above'.
+    '''
+    imageset = np.asarray(imageset)
+    xinvmags, yinvmags, ellipticities = inverse_fourier_magnitudes(imageset)
+    meanintensities = np.sum(imageset, axis=(1, 2))/((ROIradius*2 + 1)**2)
+
+    stats = {'max_intensity': np.maximum(np.max(imageset, axis=(1, 2)), 0)}
+    for name, values in (('xinvmag', xinvmags), ('yinvmag', yinvmags), ('ellipticity', ellipticities),
+                         ('mean_intensity', meanintensities)):
+        centre = np.median(values) if name == 'mean_intensity' else np.mean(values)
+        stddev = np.std(values)
+        lower, upper = centre - stddev, centre + stddev
+        stats[name] = {'values': values, 'centre': centre, 'stddev': stddev, 'lower': lower, 'upper': upper,
+                       'below': values < lower, 'good': (values < upper) & (values > lower), 'above': values > upper}
+    return stats
+
 
 def visualise_emitter_parameters(ROIradius, path):
+    # Plotting and image reading libraries are only imported when plotting.
+    import matplotlib.pyplot as plt
+    import skimage.io
+
     folder_path = path
     imageset = skimage.io.imread(folder_path)
-
-    meanintensities = []
-    maxintensities = []
-    ellipticites = []
-    xinvmags = []
-    yinvmags = []
-
-    for i in range(len(imageset)):  # change number to open desired amount of emitters
-        singleFrame = imageset[i, :, :]
-        ROI_F = np.fft.fft2(singleFrame)
-        xmagnitude = np.abs(ROI_F[0, 1])
-        xinvmag = 1/xmagnitude
-        ymagnitude = np.abs(ROI_F[1, 0])
-        yinvmag = 1/ymagnitude
-        calculated_ellipticity = xinvmag - yinvmag
-        calculated_ellipticity = (calculated_ellipticity)
-        meanintensity = np.sum(singleFrame)/((ROIradius*2 + 1)**2)
-
-        maxIntensityvalue = 0
-        # Check image intensity parameters with ideal image parameters.
-        for row in range(len(singleFrame)):
-            a = max(singleFrame[row])
-            if(a > maxIntensityvalue):
-                maxIntensityvalue = a
-
-        meanintensities.append(meanintensity)
-        maxintensities.append(maxIntensityvalue)
-        ellipticites.append(calculated_ellipticity)
-        xinvmags.append(xinvmag)
-        yinvmags.append(yinvmag)
+    stats = emitter_parameter_stats(imageset, ROIradius)
 
     figure, axis = plt.subplots(1, 4)
 
-
-    axis[0].set_title("x inverse F. mag")
-    #axis[0].hist(xinvmags, bins=55)
-    axis[0].vlines(np.mean(xinvmags) - np.std(xinvmags), 0, 120, color='r', label='mean', colors="r",linewidth=1.5)
-    axis[0].vlines(np.mean(xinvmags) + np.std(xinvmags), 0, 120, color='r', label='mean', colors="r",linewidth=1.5)
-
-    below0, good0, above0 = [], [], []
-    for x in xinvmags:
-        if(x < np.mean(xinvmags) - np.std(xinvmags)):
-            below0.append(x)
-        if(x > np.mean(xinvmags) + np.std(xinvmags)):
-            above0.append(x)
-        if(x < np.mean(xinvmags) + np.std(xinvmags) and  x > np.mean(xinvmags) - np.std(xinvmags)):
-            good0.append(x)
-
-    #axis[0].hist(below0, bins=10, color='gray') 
-    axis[0].hist(good0, bins=9, color='blue') 
-    axis[0].hist(above0, bins=9, color='gray') 
-    axis[0].set_ylabel("Counts")
-
-
-
-    axis[1].set_title("y inverse F. mag")
-    #axis[1].hist(yinvmags, bins=55)
-    axis[1].vlines(np.mean(yinvmags) - np.std(yinvmags), 0, 180, color='r', label='mean', colors="r",linewidth=1.5)
-    axis[1].vlines(np.mean(yinvmags) + np.std(yinvmags), 0, 180, color='r', label='mean', colors="r",linewidth=1.5)
-
-    below, good, above = [], [], []
-    for x in yinvmags:
-        if(x < np.mean(yinvmags) - np.std(yinvmags)):
-            below.append(x)
-        if(x > np.mean(yinvmags) + np.std(yinvmags)):
-            above.append(x)
-        if(x < np.mean(yinvmags) + np.std(yinvmags) and  x > np.mean(yinvmags) - np.std(yinvmags)):
-            good.append(x)
-
-    axis[1].hist(below, bins=4, color='gray') 
-    axis[1].hist(good, bins=6, color='blue') 
-    axis[1].hist(above, bins=8, color='gray') 
-    axis[1].set_ylabel("Counts")
-
-
-
-
-    axis[2].set_title("ellipticity")
-    #axis[2].hist(ellipticites, bins=55)
-    axis[2].vlines(np.mean(ellipticites) - np.std(ellipticites), 0, 220, color='r', label='mean', colors="r",linewidth=1.5)
-    axis[2].vlines(np.mean(ellipticites) + np.std(ellipticites), 0, 220, color='r', label='mean', colors="r",linewidth=1.5)
-
-    below2, good2, above2 = [], [], []
-    for x in ellipticites:
-        if(x < np.mean(ellipticites) - np.std(ellipticites)):
-            below2.append(x)
-        if(x > np.mean(ellipticites) + np.std(ellipticites)):
-            above2.append(x)
-        if(x < np.mean(ellipticites) + np.std(ellipticites) and  x > np.mean(ellipticites) - np.std(ellipticites)):
-            good2.append(x)
-
-    axis[2].hist(below2, bins=8, color='gray') 
-    axis[2].hist(good2, bins=6, color='blue') 
-    axis[2].hist(above2, bins=8, color='gray') 
-    axis[2].set_ylabel("Counts")
-
-
-
-    axis[3].set_title("mean intensity counts")
-    #axis[3].hist(meanintensities, bins=55) 
-    axis[3].vlines(np.median(meanintensities) - np.std(meanintensities), 0, 100, color='r', label='mean', colors="r",linewidth=1.5)
-    axis[3].vlines(np.median(meanintensities) + np.std(meanintensities), 0, 100, color='r', label='mean', colors="r",linewidth=1.5)
-
-    below3, good3, above3 = [], [], []
-    for x in meanintensities:
-        if(x < np.median(meanintensities) - np.std(meanintensities)):
-            below3.append(x)
-        if(x > np.median(meanintensities) + np.std(meanintensities)):
-            above3.append(x)
-        if(x < np.median(meanintensities) + np.std(meanintensities) and  x > np.median(meanintensities) - np.std(meanintensities)):
-            good3.append(x)
-
-    axis[3].hist(below3, bins=4, color='gray') 
-    axis[3].hist(good3, bins=8, color='blue') 
-    axis[3].hist(above3, bins=6, color='gray') 
-    #axis[3].hist(meanintensities, bins=18, color='gray') 
-    axis[3].set_ylabel("Counts")
-
+    for i, (name, title, height, bins) in enumerate(PLOT_SETTINGS):
+        parameter = stats[name]
+        axis[i].set_title(title)
+        axis[i].vlines(parameter['lower'], 0, height, color='r', label='mean', colors="r",linewidth=1.5)
+        axis[i].vlines(parameter['upper'], 0, height, color='r', label='mean', colors="r",linewidth=1.5)
+        for part, partBins, colour in zip(('below', 'good', 'above'), bins, ('gray', 'blue', 'gray')):
+            if(partBins is not None):
+                axis[i].hist(parameter['values'][parameter[part]], bins=partBins, color=colour)
+        axis[i].set_ylabel("Counts")
+
+    meanintensities = stats['mean_intensity']['values']
+    ellipticites = stats['ellipticity']['values']
     print("Amount of emitter frames in file:", len(meanintensities))
     print("\n")
     print("mean intensity", np.mean(meanintensities))
-    print("\n")    
+    print("\n")
     print("std dev intensities", np.std(meanintensities))
-    print("mean max int 0:", np.mean(maxintensities))
+    print("mean max int 0:", np.mean(stats['max_intensity']))
 
     print("\n mean ellipticities : ", np.mean(ellipticites))
     print("std dev ellipticities", np.std(ellipticites))
     print("\n")
 
-    print("mean x inv mag 0:", np.mean(xinvmags))
-    print("mean y inv mag 0:", np.mean(yinvmags))
+    print("mean x inv mag 0:", np.mean(stats['xinvmag']['values']))
+    print("mean y inv mag 0:", np.mean(stats['yinvmag']['values']))
+
 
 
-    
     plt.show()
 
 
@@ -147,5 +80,3 @@ if __name__ == "__main__":
     #visualise_emitter_parameters(4, "QdotParameterEstimation/goQdots/e605_1_filtered_1k_9x9_lp3_go.tiff")
     visualise_emitter_parameters(4, "QdotParameterEstimation/goQdots/e655_1_filtered_1k_9x9_lp3_go.tiff")
     #visualise_emitter_parameters(4, "QdotParameterEstimation/goQdots/e705_1_filtered_1k_9x9_lp3_go.tiff")
-
-
@@ -0,0 +1,70 @@
+import numpy as np
+
+
+class EmitterBuffer:
+    '''
+    Array storage for accepted emitters: a (capacity, ROIsize, ROIsize) ROI array and a parallel structured
+    metadata array (frame, y, x and ROI features, see emitterFeatures.FEATURE_DTYPE).
+    Accepted ROIs are copied in once, so no references to movie frames are kept and memory scales with the
+    amount of emitters kept, not with the input movie size.
+    Storage is allocated on the first extend (the ROI data type is taken from the data) for at most
+    max_preallocate emitters and doubles when it is full.
+
+    len(buffer) is the amount of emitters, rois and metadata give views of the filled part and
+    np.asarray(buffer) gives the ROI array without copying it.
+    '''
+    def __init__(self, capacity, ROIsize, metadata_dtype, max_preallocate=65536):
+        self.capacity = max(1, min(capacity, max_preallocate))
+        self.ROIsize = ROIsize
+        self.metadata_dtype = metadata_dtype
+        self._rois = None
+        self._metadata = None
+        self.length = 0
+
+    def _reserve(self, length, dtype):
+        if(self._rois is None):
+            self._rois = np.empty((max(self.capacity, length), self.ROIsize, self.ROIsize), dtype=dtype)
+            self._metadata = np.zeros(len(self._rois), dtype=self.metadata_dtype)
+        elif(length > len(self._rois)):
+            capacity = max(length, 2*len(self._rois))
+            rois = np.empty((capacity,) + self._rois.shape[1:], dtype=self._rois.dtype)
+            rois[:self.length] = self._rois[:self.length]
+            metadata = np.zeros(capacity, dtype=self.metadata_dtype)
+            metadata[:self.length] = self._metadata[:self.length]
+            self._rois, self._metadata = rois, metadata
+
+    def extend(self, rois, metadata):
+        # Copy a stack of ROIs and their metadata rows into the buffer.
+        rois = np.asarray(rois)
+        if(len(rois) == 0):
+            return
+        self._reserve(self.length + len(rois), rois.dtype)
+        self._rois[self.length:self.length + len(rois)] = rois
+        self._metadata[self.length:self.length + len(rois)] = metadata
+        self.length += len(rois)
+
+    @property
+    def rois(self):
+        if(self._rois is None):
+            return np.zeros((0, self.ROIsize, self.ROIsize))
+        return self._rois[:self.length]
+
+    @property
+    def metadata(self):
+        if(self._metadata is None):
+            return np.zeros(0, dtype=self.metadata_dtype)
+        return self._metadata[:self.length]
+
+    def __len__(self):
+        return self.length
+
+    def __getitem__(self, index):
+        return self.rois[index]
+
+    def __iter__(self):
+        return iter(self.rois)
+
+    def __array__(self, dtype=None, copy=None):
+        if(copy):
+            return np.array(self.rois, dtype=dtype)
+        return np.asarray(self.rois, dtype=dtype)
@@ -0,0 +1,107 @@
+'''
+Batched emitter ROI features.
+All functions work on a stack of ROIs of shape (N, 2*ROIradius+1, 2*ROIradius+1) at once
+and give the same accept/reject decisions as slicing and testing each ROI on its own.
+'''
+from functools import lru_cache
+
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+
+from stageProfiler import timed
+
+
+# Feature table of candidate ROIs, one row per ROI, see EmitterMovie.extract_features.
+FEATURE_DTYPE = np.dtype([('frame', np.int64), ('y', np.int64), ('x', np.int64),
+                          ('mean_intensity', np.float64), ('xinvmag', np.float64), ('yinvmag', np.float64),
+                          ('ellipticity', np.float64), ('edge_ok', bool), ('single_peak', bool)])
+
+
+def inside_border(peaks, frameShape, BorderRegion):
+    # Boolean mask of (y, x) peaks further than BorderRegion+1 pixels from every edge of a frame.
+    edge = BorderRegion + 1
+    peaks = np.asarray(peaks).reshape(-1, 2)
+    return (peaks[:, 0] > edge) & (peaks[:, 0] < frameShape[0] - edge) \
+        & (peaks[:, 1] > edge) & (peaks[:, 1] < frameShape[1] - edge)
+
+
+def gather_rois(image, peaks, ROIradius):
+    # Extract all ROIs centered on peaks with one fancy index into a strided window view.
+    # image is a single frame (peaks are (y, x) rows) or a stack of frames (peaks are (frame, y, x) rows).
+    # Returns a contiguous (N, 2*ROIradius+1, 2*ROIradius+1) array.
+    size = ROIradius*2 + 1
+    peaks = np.asarray(peaks, dtype=np.intp).reshape(-1, image.ndim)
+    windows = sliding_window_view(image, (size, size), axis=(-2, -1))
+    index = tuple(peaks[:, :-2].T) + (peaks[:, -2] - ROIradius, peaks[:, -1] - ROIradius)
+    return windows[index]
+
+
+@lru_cache(maxsize=None)
+def _dft_basis(size):
+    # Real and imaginary parts of exp(-2*pi*i*k/size) as the columns of a (size, 2) matrix.
+    angle = 2*np.pi*np.arange(size)/size
+    return np.stack((np.cos(angle), -np.sin(angle)), axis=1)
+
+
+def fourier_bins(rois):
+    # The two coefficients of np.fft.fft2(ROI) used as features, ROI_F[0, 1] and ROI_F[1, 0],
+    # for every ROI, computed as dot products of the column/row sums with one DFT basis vector.
+    rois = np.asarray(rois, dtype=float)
+    xbin = np.sum(rois, axis=1) @ _dft_basis(rois.shape[2])
+    ybin = np.sum(rois, axis=2) @ _dft_basis(rois.shape[1])
+    return xbin[:, 0] + 1j*xbin[:, 1], ybin[:, 0] + 1j*ybin[:, 1]
+
+
+def inverse_fourier_magnitudes(rois):
+    # x,y inverse Fourier magnitude and ellipticity (their difference) of every ROI.
+    xbin, ybin = fourier_bins(rois)
+    xinvmag = 1/np.abs(xbin)
+    yinvmag = 1/np.abs(ybin)
+    return xinvmag, yinvmag, xinvmag - yinvmag
+
+
+def count_roi_peaks(rois, thresholds):
+    # Number of peaks skimage.feature.peak_local_max(ROI, threshold_abs=threshold) finds in each ROI,
+    # for a whole stack of ROIs at once without skimage's per call overhead.
+    # peak_local_max defaults: a peak is a pixel equal to the maximum of its 3x3 neighbourhood (ties are all peaks)
+    # and above threshold, pixels on the 1 pixel border are excluded, and a ROI where every pixel
+    # equals its neighbourhood maximum has no peaks. That only happens for a flat ROI.
+    rois = np.asarray(rois)
+    thresholds = np.asarray(thresholds).reshape(-1, 1, 1)
+    height, width = rois.shape[1:]
+    centre = rois[:, 1:height - 1, 1:width - 1]
+    isMax = centre > thresholds
+    for dy in (-1, 0, 1):
+        for dx in (-1, 0, 1):
+            if(dy or dx):
+                isMax &= centre >= rois[:, 1 + dy:height - 1 + dy, 1 + dx:width - 1 + dx]
+    counts = np.count_nonzero(isMax, axis=(1, 2))
+    counts[np.max(rois, axis=(1, 2)) == np.min(rois, axis=(1, 2))] = 0
+    return counts
+
+
+def check_roi_peak_counts(rois, thresholds):
+    # Amount of ROIs where count_roi_peaks disagrees with len(peak_local_max(ROI, threshold_abs=threshold)).
+    from skimage.feature import peak_local_max
+    counts = count_roi_peaks(rois, thresholds)
+    reference = [len(peak_local_max(ROI, threshold_abs=threshold)) for ROI, threshold in zip(rois, np.ravel(thresholds))]
+    return int(np.count_nonzero(counts != np.asarray(reference, dtype=counts.dtype)))
+
+
+def roi_features(rois, edge_peak_threshold_value, edge_value_multiplier=1, profiler=None):
+    # Mean intensity, x,y inverse Fourier magnitude, ellipticity, edge and single peak checks for every ROI.
+    # The single peak check is timed as the 'peak_test' stage of profiler (a stageProfiler.StageProfiler).
+    rois = np.asarray(rois)
+    ROIarea = rois.shape[1]*rois.shape[2]
+
+    xinvmag, yinvmag, ellipticity = inverse_fourier_magnitudes(rois)
+    meanIntensity = np.sum(rois, axis=(1, 2))/ROIarea
+
+    MinValueLocalMaxR = np.std(rois, axis=(1, 2))*edge_peak_threshold_value
+    edgeValue = MinValueLocalMaxR*edge_value_multiplier
+    edgeMax = np.maximum.reduce([rois[:, :, 0].max(axis=1), rois[:, :, -1].max(axis=1),
+                                 rois[:, 0, :].max(axis=1), rois[:, -1, :].max(axis=1)])
+    edge_ok = edgeMax < edgeValue
+    with timed(profiler, 'peak_test', len(rois)):
+        single_peak = count_roi_peaks(rois, MinValueLocalMaxR) == 1
+    return meanIntensity, xinvmag, yinvmag, ellipticity, edge_ok, single_peak
@@ -0,0 +1,179 @@
+'''
+Batched sub-pixel localisation of emitters.
+All functions work on a stack of ROIs of shape (N, 2*ROIradius+1, 2*ROIradius+1) at once, the Gaussian fit
+runs Levenberg-Marquardt iterations over arrays of all ROIs instead of one fit per ROI.
+Positions are pixel coordinates of the frame (see PIXEL_CENTRE, syntheticMovies uses the same coordinates for
+its ground truth) when the ROI centres are given, otherwise offsets from the ROI centre pixel.
+'''
+import numpy as np
+from scipy.ndimage import map_coordinates
+
+from emitterFeatures import FEATURE_DTYPE
+
+
+# Localisation of every ROI, one row per ROI. photons is the integrated emitter signal in counts above background
+# (divide by the camera gain for photo electrons), fit_ok is False for fits which did not converge or ended
+# outside the ROI.
+LOCALISATION_DTYPE = np.dtype([('y_position', np.float64), ('x_position', np.float64), ('sigma_y', np.float64),
+                               ('sigma_x', np.float64), ('photons', np.float64), ('background', np.float64),
+                               ('fit_ok', bool)])
+# Feature table rows with their localisation, see EmitterMovie localisation.
+LOCALISED_FEATURE_DTYPE = np.dtype(FEATURE_DTYPE.descr + LOCALISATION_DTYPE.descr)
+LOCALISATION_METHODS = ('centroid', 'gaussian')
+
+# Pixel coordinates of the centre of a pixel: pixel (i, j) is centred at (i + PIXEL_CENTRE, j + PIXEL_CENTRE).
+# 0 matches the integer peak positions of EmitterMovie, pixel (i, j) covers [i - 0.5, i + 0.5) x [j - 0.5, j + 0.5).
+PIXEL_CENTRE = 0.0
+
+MIN_SIGMA = 0.3 # pixels
+
+
+def _grid(rois):
+    # Pixel offsets from the ROI centre, (height, 1) and (width,) arrays.
+    height, width = rois.shape[1:]
+    return np.arange(height)[:, np.newaxis] - (height - 1)/2, np.arange(width) - (width - 1)/2
+
+
+def roi_background(rois):
+    # Median of the edge pixels of every ROI.
+    rois = np.asarray(rois, dtype=float)
+    edge = np.concatenate((rois[:, 0, :], rois[:, -1, :], rois[:, 1:-1, 0], rois[:, 1:-1, -1]), axis=1)
+    return np.median(edge, axis=1)
+
+
+def centroid_localise(rois):
+    '''
+    (y, x, sigma_y, sigma_x, photons, background) arrays from the first and second moments of the
+    background subtracted (negative values set to 0) intensity of every ROI, offsets from the ROI centre.
+    '''
+    rois = np.asarray(rois, dtype=float)
+    Y, X = _grid(rois)
+    background = roi_background(rois)
+    signal = np.maximum(rois - background[:, np.newaxis, np.newaxis], 0)
+    total = signal.sum(axis=(1, 2))
+    weight = np.where(total > 0, total, 1)
+    y = np.sum(signal*Y, axis=(1, 2))/weight
+    x = np.sum(signal*X, axis=(1, 2))/weight
+    sigmaY = np.sqrt(np.maximum(np.sum(signal*Y**2, axis=(1, 2))/weight - y**2, MIN_SIGMA**2))
+    sigmaX = np.sqrt(np.maximum(np.sum(signal*X**2, axis=(1, 2))/weight - x**2, MIN_SIGMA**2))
+    return y, x, sigmaY, sigmaX, total, background
+
+
+def _gaussian(parameters, Y, X):
+    # Model ROIs (N, pixels) and transposed Jacobian (N, 6, pixels) of an elliptical Gaussian with parameters
+    # (y, x, sigma_y, sigma_x, photons, background) for every ROI, photons being the integral of the Gaussian.
+    y, x, sigmaY, sigmaX, photons, background = (parameters[:, i, np.newaxis] for i in range(6))
+    dy, dx = Y - y, X - x
+    shape = np.exp(-0.5*((dy/sigmaY)**2 + (dx/sigmaX)**2))
+    jacobian = np.empty((len(parameters), 6, len(Y)))
+    jacobian[:, 4] = shape/(2*np.pi*sigmaY*sigmaX)
+    peak = photons*jacobian[:, 4]
+    jacobian[:, 0] = peak*dy/sigmaY**2
+    jacobian[:, 1] = peak*dx/sigmaX**2
+    jacobian[:, 2] = (jacobian[:, 0]*dy - peak)/sigmaY
+    jacobian[:, 3] = (jacobian[:, 1]*dx - peak)/sigmaX
+    jacobian[:, 5] = 1
+    return background + peak, jacobian
+
+
+def _fit(data, parameters, Y, X, radius, iterations, tolerance):
+    # Levenberg-Marquardt iterations of gaussian_localise for a chunk of ROIs (data is (N, pixels)).
+    count = len(data)
+    model, jacobian = _gaussian(parameters, Y, X)
+    cost = np.sum((data - model)**2, axis=1)
+    damping = np.full(count, 1e-3)
+    converged = np.zeros(count, dtype=bool)
+    active = np.arange(count)
+    for _ in range(iterations):
+        if(len(active) == 0):
+            break
+        J = jacobian[active]
+        normal = J @ J.transpose(0, 2, 1)
+        gradient = J @ (data[active] - model[active])[:, :, np.newaxis]
+        diagonal = np.einsum('nii->ni', normal) # view of the diagonals, damped in place
+        diagonal *= 1 + damping[active, np.newaxis]
+        diagonal += 1e-12
+        trial = parameters[active] + np.linalg.solve(normal, gradient)[:, :, 0]
+        trial[:, 2:4] = np.clip(trial[:, 2:4], MIN_SIGMA, 2*radius)
+        trial[:, 4] = np.maximum(trial[:, 4], 1e-6)
+        trialModel, trialJacobian = _gaussian(trial, Y, X)
+        trialCost = np.sum((data[active] - trialModel)**2, axis=1)
+
+        # Better steps are taken with less damping, worse ones are retried with more damping.
+        better = trialCost < cost[active]
+        improved = active[better]
+        done = better & (cost[active] - trialCost <= tolerance*cost[active])
+        parameters[improved] = trial[better]
+        model[improved] = trialModel[better]
+        jacobian[improved] = trialJacobian[better]
+        cost[improved] = trialCost[better]
+        damping[active] = np.where(better, damping[active]/10, damping[active]*10)
+        done |= damping[active] > 1e10 # no step lowers the cost any more: at a minimum
+        converged[active[done]] = True
+        active = active[~done]
+    return converged
+
+
+def gaussian_localise(rois, iterations=20, tolerance=1e-6, chunk_size=512):
+    '''
+    Least squares fit of an elliptical (axis aligned) Gaussian plus constant background to every ROI,
+    started from centroid_localise. ROIs are fitted together by batched Levenberg-Marquardt iterations,
+    chunk_size ROIs at a time so the arrays stay in cache: (N, 6, 6) normal equations are solved at once and
+    every ROI has its own damping factor, ROIs whose cost changed by less than tolerance (relative) stop
+    being updated.
+    Returns (y, x, sigma_y, sigma_x, photons, background, converged), offsets from the ROI centre.
+    '''
+    rois = np.asarray(rois, dtype=float)
+    Y, X = np.broadcast_arrays(*_grid(rois))
+    Y, X = Y.ravel(), X.ravel()
+    data = rois.reshape(len(rois), len(Y))
+    radius = (max(rois.shape[1:]) - 1)/2
+
+    parameters = np.column_stack(centroid_localise(rois))
+    parameters[:, 2:4] = np.clip(parameters[:, 2:4], MIN_SIGMA, radius)
+    parameters[:, 4] = np.maximum(parameters[:, 4], 1)
+    converged = np.zeros(len(rois), dtype=bool)
+    for start in range(0, len(rois), chunk_size):
+        chunk = slice(start, start + chunk_size)
+        fitted = parameters[chunk] # view, updated by _fit
+        converged[chunk] = _fit(data[chunk], fitted, Y, X, radius, iterations, tolerance)
+    return tuple(parameters.T) + (converged,)
+
+
+def localise(rois, method='gaussian', centres=None, iterations=20):
+    '''
+    LOCALISATION_DTYPE table of a ROI stack with method 'centroid' or 'gaussian' (see LOCALISATION_METHODS).
+    centres are the (y, x) pixel indices of the ROI centre pixels (e.g. the y and x feature columns), positions are
+    then pixel coordinates (see PIXEL_CENTRE), without them positions are offsets from the ROI centre.
+    '''
+    rois = np.asarray(rois, dtype=float)
+    table = np.zeros(len(rois), dtype=LOCALISATION_DTYPE)
+    if(method == 'centroid'):
+        y, x, sigmaY, sigmaX, photons, background = centroid_localise(rois)
+        fitOk = photons > 0
+    elif(method == 'gaussian'):
+        y, x, sigmaY, sigmaX, photons, background, fitOk = gaussian_localise(rois, iterations)
+    else:
+        raise ValueError("method must be one of " + str(LOCALISATION_METHODS))
+    height, width = rois.shape[1:]
+    table['fit_ok'] = fitOk & (np.abs(y) <= (height - 1)/2) & (np.abs(x) <= (width - 1)/2)
+    if(centres is not None):
+        centres = np.asarray(centres, dtype=float).reshape(-1, 2) + PIXEL_CENTRE
+        y, x = y + centres[:, 0], x + centres[:, 1]
+    (table['y_position'], table['x_position'], table['sigma_y'], table['sigma_x'], table['photons'],
+        table['background']) = y, x, sigmaY, sigmaX, photons, background
+    return table
+
+
+def recentre_rois(rois, offsets, order=1):
+    '''
+    ROIs resampled so the (y, x) offsets (N, 2) from the ROI centre (e.g. of localise without centres) become
+    the centre, by spline interpolation of order order (1: bilinear) within every ROI.
+    Pixels beyond the ROI edge take the value of the nearest edge pixel. Returns float64 ROIs.
+    '''
+    rois = np.asarray(rois, dtype=float)
+    offsets = np.asarray(offsets, dtype=float).reshape(-1, 2)
+    # The stack is one 3D spline, which is exact at the integer ROI indices: ROIs are not mixed.
+    index, Y, X = np.meshgrid(np.arange(len(rois)), np.arange(rois.shape[1]), np.arange(rois.shape[2]), indexing='ij')
+    coordinates = np.stack((index, Y + offsets[:, 0, np.newaxis, np.newaxis], X + offsets[:, 1, np.newaxis, np.newaxis]))
+    return map_coordinates(rois, coordinates, order=order, mode='nearest')
@@ -0,0 +1,23 @@
+# EmitterMovie parameters used unless a profile or a job sets them.
+DEFAULT_PARAMETERS = {
+    'GaussianFiltersigma1': 0.01, 'GaussianFiltersigma2': 3, # Gaussian blurring filter sigmas.
+    'ROIradius': 4, # Generates ROI of (2*ROIradius + 1) ** 2.
+    'BorderRegion': 20, # Distance from edges where emitters are discarded.
+    'emitter_list_length': 1000, # Final filtered movie size.
+    'test_emitter_list_length': 1000, # Amount of emitters from which acceptance values are calculated.
+    'edge_peak_threshold_value': 3,
+    'use_input_parameter_vals': False, # If False, generates acceptance data from file, if True uses input data.
+    # Acceptance data
+    'xinvmag_mean': 2.4878015175981878e-05, 'xinvmag_stddev': 1.5717972575586092e-05,
+    'yinvmag_mean': 2.4031295141239076e-05, 'yinvmag_stddev': 1.5884859638799993e-05,
+    'ellipticity_mean': 8.467200347428055e-07, 'ellipticity_stddev': 6.000592627336967e-06,
+    'median_IntensityRange': 2504.0123456790125, 'stddev_IntensityRange': 882.0797299810998,
+    'edge_value_multiplier': 1, 'single_pass': True, 'calibration_sampling': 'first', 'calibration_seed': None,
+    'detection_backend': 'reference',
+    'feature_cache': None, # directory of a featureCache.FeatureCache
+    'localisation': None, 'recentre_rois': False, # sub-pixel localisation of accepted emitters
+}
+
+# lp3 is the standard profile, lp10 the low intensity profile (more tolerant ROI peak and edge thresholds).
+PROFILES = {'lp3': {'edge_peak_threshold_value': 3},
+            'lp10': {'edge_peak_threshold_value': 10, 'edge_value_multiplier': 2}}
@@ -0,0 +1,155 @@
+'''
+Streaming training input for the emitter classifiers (tf.data), so training does not need all emitters in memory.
+
+Emitter sources read blocks of frames from a packed dataset (see packedDataset) or from emitter Tiff files
+(scaleEmitters or EmitterMovie output) and centre and normalise every frame of a block (scaleEmitters.normalize_frames).
+emitter_dataset turns a source into a tf.data pipeline: blocks are read in shuffled order by parallel reads,
+frames are shuffled in a bounded buffer, batched and prefetched while the model trains.
+
+    source = PackedEmitterSource('dataset.emitters')
+    train, test = source.split(test_size=0.2, seed=42)
+    cnn.fit(emitter_dataset(train, batch_size=64, seed=1), epochs=10)
+
+TensorFlow is only imported by emitter_dataset.
+'''
+import copy
+import threading
+
+import numpy as np
+
+from movieReader import TiffMovieReader
+from packedDataset import PackedDataset, frame_shape
+from scaleEmitters import normalize_frames
+
+
+class EmitterSource:
+    '''
+    Frames and int labels of a set of emitters, read in blocks of at most block_size frames.
+    index (default: all frames) selects the frames used, blocks hold consecutive selected frames so each block
+    is one read of nearby frames. normalisation is a scaleEmitters.NORMALISATION_MODES mode applied to every
+    frame as it is read, or None for frames which are used as they are.
+    Already scaled frames are not changed by the default 'spectral' normalisation (up to rounding).
+    Use subset or split to select frames, and read(block) for the (float32 frames, int32 labels) of a block.
+    Sources which open files (TiffEmitterSource) close them with close or at the end of a with block.
+    '''
+    def __init__(self, labels, frame_shape, class_names, index=None, block_size=1024, normalisation='spectral'):
+        self.labels = labels
+        self.frame_shape = tuple(frame_shape)
+        self.class_names = class_names
+        self.block_size = block_size
+        self.normalisation = normalisation
+        self._set_index(np.arange(len(labels)) if index is None else index)
+
+    def _set_index(self, index):
+        self.index = np.sort(np.asarray(index, dtype=np.int64))
+        self.blocks = [self.index[start:start + self.block_size] for start in range(0, len(self.index), self.block_size)]
+
+    def __len__(self):
+        return len(self.index)
+
+    def subset(self, index):
+        # Source of the frames index (indices of all frames of the source, not of the current selection).
+        source = copy.copy(self)
+        source._set_index(index)
+        return source
+
+    def split(self, test_size=0.2, seed=None):
+        # (train source, test source), a random split of the selected frames.
+        index = np.random.default_rng(seed).permutation(self.index)
+        testCount = int(np.ceil(test_size*len(index)))
+        return self.subset(index[testCount:]), self.subset(index[:testCount])
+
+    def close(self):
+        pass # nothing to close, see TiffEmitterSource
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def _frames(self, index):
+        raise NotImplementedError
+
+    def read(self, block):
+        index = self.blocks[int(block)]
+        frames = np.asarray(self._frames(index), dtype=float)
+        if(self.normalisation is not None):
+            frames = normalize_frames(frames, self.normalisation)
+        return frames.astype(np.float32), np.asarray(self.labels[index], dtype=np.int32)
+
+
+class PackedEmitterSource(EmitterSource):
+    # Emitters of a packed dataset (a PackedDataset or its path), frames are read from the memory map.
+    def __init__(self, dataset, index=None, block_size=1024, normalisation='spectral'):
+        self.dataset = PackedDataset(dataset) if isinstance(dataset, str) else dataset
+        super().__init__(np.asarray(self.dataset.labels), self.dataset.images.shape[1:], self.dataset.class_names,
+                         index, block_size, normalisation)
+
+    def _frames(self, index):
+        return self.dataset.images[index]
+
+
+class TiffEmitterSource(EmitterSource):
+    # Emitters of Tiff files, colours is a list of (colour name, [Tiff paths]) pairs and the label of a colour
+    # is its position in the list. Frame indices count through all files in this order.
+    # The files stay open until close, subsets and splits share them with their source.
+    def __init__(self, colours, index=None, block_size=1024, normalisation='spectral'):
+        self.readers = []
+        try:
+            counts = [] # frames of every colour
+            for _, files in colours:
+                count = 0
+                for file in files:
+                    self.readers.append(TiffMovieReader(file))
+                    count += len(self.readers[-1])
+                counts.append(count)
+            frameShape = frame_shape(self.readers)
+        except Exception:
+            self.close()
+            raise
+        self.offsets = np.concatenate(([0], np.cumsum([len(reader) for reader in self.readers])))
+        labels = np.repeat(np.arange(len(colours), dtype=np.int8), counts)
+        self._lock = threading.Lock() # Tiff page reads share a file handle
+        super().__init__(labels, frameShape, [str(name) for name, _ in colours], index, block_size, normalisation)
+
+    def _frames(self, index):
+        frames = np.empty((len(index),) + self.frame_shape)
+        files = np.searchsorted(self.offsets, index, side='right') - 1
+        for file in np.unique(files):
+            selected = files == file
+            local = index[selected] - self.offsets[file]
+            with self._lock:
+                stack = np.array(self.readers[file].read_range(local[0], local[-1] + 1))
+            frames[selected] = stack[local - local[0]]
+        return frames
+
+    def close(self):
+        for reader in self.readers:
+            reader.close()
+
+
+def emitter_dataset(source, batch_size=64, shuffle_buffer=10000, seed=None, parallel_reads=None):
+    '''
+    tf.data.Dataset of (frames, labels) batches of an EmitterSource.
+    Blocks are read in a new random order every epoch by parallel_reads parallel reads (default: tuned by tf.data),
+    frames are shuffled in a buffer of shuffle_buffer frames (0: no shuffling, blocks are then read in order),
+    and batches are prefetched. Memory use is bounded by the buffer and the blocks being read.
+    '''
+    import tensorflow as tf # optional, only needed for training
+
+    blocks = tf.data.Dataset.range(len(source.blocks))
+    if(shuffle_buffer):
+        blocks = blocks.shuffle(max(len(source.blocks), 1), seed=seed, reshuffle_each_iteration=True)
+
+    def read(block):
+        frames, labels = tf.numpy_function(source.read, [block], (tf.float32, tf.int32))
+        frames.set_shape((None,) + source.frame_shape)
+        labels.set_shape((None,))
+        return frames, labels
+
+    dataset = blocks.map(read, num_parallel_calls=parallel_reads or tf.data.AUTOTUNE,
+                         deterministic=seed is not None).unbatch()
+    if(shuffle_buffer):
+        dataset = dataset.shuffle(shuffle_buffer, seed=seed, reshuffle_each_iteration=True)
+    return dataset.batch(batch_size).prefetch(tf.data.AUTOTUNE)
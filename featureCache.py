@@ -0,0 +1,78 @@
+import hashlib
+import json
+import os
+
+import numpy as np
+
+
+class FeatureCache:
+    '''
+    On disk cache of detected emitter candidates (peak coordinates and ROIs) of whole movies.
+    Entries are .npz files in directory (default: a .emitter_cache folder next to each movie), keyed by the movie
+    file (path, size and modification time) and the detection parameters (Gaussian sigmas, detection backend,
+    BorderRegion and ROIradius). Changing the movie or any of those parameters gives a new entry,
+    while edge/peak thresholds and acceptance ranges can be changed freely, as ROI features are recomputed
+    from the cached ROIs.
+    When the entries of a cache directory are larger than max_bytes together, least recently used entries are removed
+    (the newest entry is always kept).
+    '''
+    def __init__(self, directory=None, max_bytes=2*1024**3):
+        self.directory = directory
+        self.max_bytes = max_bytes
+
+    def _directory(self, path):
+        if(self.directory is not None):
+            return self.directory
+        return os.path.join(os.path.dirname(os.path.abspath(path)), '.emitter_cache')
+
+    def key(self, path, detection_parameters):
+        # Hash of movie file identity and detection parameters (a dict).
+        stat = os.stat(path)
+        identity = {'path': os.path.realpath(path), 'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns,
+                    'parameters': detection_parameters}
+        return hashlib.sha1(json.dumps(identity, sort_keys=True).encode()).hexdigest()
+
+    def _entry(self, path, detection_parameters):
+        return os.path.join(self._directory(path), self.key(path, detection_parameters) + '.npz')
+
+    def load(self, path, detection_parameters):
+        # Cached (frames, peaks, rois, movie length) of a movie, or None.
+        entry = self._entry(path, detection_parameters)
+        try:
+            with np.load(entry) as cached:
+                frames, peaks, rois, length = cached['frames'], cached['peaks'], cached['rois'], int(cached['length'])
+            os.utime(entry) # mark as recently used
+        except FileNotFoundError: # not cached, or evicted by another process sharing the cache
+            return None
+        return frames, peaks, rois, length
+
+    def store(self, path, detection_parameters, frames, peaks, rois, length):
+        directory = self._directory(path)
+        os.makedirs(directory, exist_ok=True)
+        entry = self._entry(path, detection_parameters)
+        temporary = entry + '.' + str(os.getpid()) + '.tmp' # processes sharing the cache may store the same entry
+        with open(temporary, 'wb') as f:
+            np.savez(f, frames=frames, peaks=peaks, rois=rois, length=length)
+        os.replace(temporary, entry)
+        self.evict(directory)
+
+    def evict(self, directory):
+        # Remove least recently used entries until the cache is within max_bytes.
+        # Several processes can share a cache directory and evict at once, entries they removed are skipped.
+        entries = []
+        for name in os.listdir(directory):
+            if(name.endswith('.npz')):
+                try:
+                    stat = os.stat(os.path.join(directory, name))
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, os.path.join(directory, name)))
+        entries.sort(reverse=True)
+        total = 0
+        for index, (_, size, entry) in enumerate(entries):
+            total += size
+            if(total > self.max_bytes and index > 0): # always keep the newest entry
+                try:
+                    os.remove(entry)
+                except FileNotFoundError:
+                    pass
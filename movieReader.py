@@ -0,0 +1,67 @@
+import numpy as np
+import tifffile
+
+
+class TiffMovieReader:
+    '''
+    Lazy frame access to a multi-frame Tiff movie, so a movie never has to be loaded into memory at once.
+    Uncompressed movies are memory-mapped, otherwise (or when the movie cannot be mapped, e.g. under an address
+    space limit) every frame is read from its own Tiff page when requested.
+    Movies whose frames are not stored one per page (rare, e.g. compressed volumes) are read in full once.
+
+    Use as a context manager or call close when done.
+    len(reader) gives the amount of frames, reader[i] reads frame i and reader.read_range(start, stop) a stack.
+    Iterating (or frames) yields (frame index, frame) pairs and only reads a frame when it is reached,
+    so a loop which stops early stops reading the file.
+    '''
+    def __init__(self, path, use_memmap=True):
+        self.path = path
+        self._tif = tifffile.TiffFile(path)
+        self._series = self._tif.series[0]
+        self._stack = None
+        if(use_memmap):
+            try:
+                self._stack = tifffile.memmap(path, series=0, mode='r')
+            except (ValueError, OSError): # compressed or non contiguous data, or no address space left
+                self._stack = None
+        self.shape = (1,)*(3 - len(self._series.shape)) + tuple(self._series.shape)[-3:]
+        self.dtype = self._series.dtype
+        if(self._stack is None and len(self._series.pages) != self.shape[0]):
+            self._stack = self._series.asarray()
+        if(self._stack is not None):
+            self._stack = self._stack.reshape(self.shape)
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, frame):
+        if(self._stack is not None):
+            return self._stack[frame]
+        return self._tif.asarray(key=range(len(self))[frame], series=0)
+
+    def read_range(self, start, stop):
+        # Stack of frames start to stop, only those pages are read.
+        frames = range(len(self))[start:stop]
+        if(self._stack is not None):
+            return self._stack[frames.start:frames.stop]
+        if(len(frames) == 0):
+            return np.zeros((0,) + self.shape[1:], dtype=self.dtype)
+        return self._tif.asarray(key=frames, series=0).reshape((len(frames),) + self.shape[1:])
+
+    def frames(self, frames=None):
+        # Generator of (frame index, frame) for frames (any iterable of indices, default all frames).
+        for frame in (range(len(self)) if frames is None else frames):
+            yield frame, self[frame]
+
+    def __iter__(self):
+        return self.frames()
+
+    def close(self):
+        self._stack = None
+        self._tif.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
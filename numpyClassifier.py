@@ -0,0 +1,278 @@
+'''
+TensorFlow free inference of the notebook emitter classifiers.
+
+export_model writes the weights of a trained Keras classifier (Input, Dense, Dropout, Flatten and Activation
+layers, as in BinaryColourClassification.ipynb and MultiColourClassification.ipynb) to a NumPy .npz file, with
+float32, float16 or int8 (per output unit scaled) weights. NumpyClassifier loads such a file in milliseconds and
+predicts with batched matrix products: the Dense layers before Flatten are applied to every pixel at once as one
+(ROIs*pixels, units) product, in chunks of ROIs which keep the intermediate arrays small.
+float16 and int8 only make the file and memory smaller, products are always computed in float32.
+
+With one input channel, the layers before Flatten map every pixel value to a vector by the same function, which is
+piecewise linear for linear, relu and leaky_relu activations. export_model then also finds its linear pieces and
+folds them into the first Dense layer after Flatten: a table of (slope, offset) per piece, pixel and unit. Prediction
+then only looks up the piece of every pixel and sums 81 slope*value + offset terms per unit, which gives the same
+probabilities (up to rounding) at a tiny fraction of the products.
+
+    python numpyClassifier.py colour_classifier.keras colour_classifier.npz --classes 605 655 [--weights int8] [--check dataset.emitters]
+'''
+import argparse
+import json
+
+import numpy as np
+
+
+VERSION = 1
+WEIGHT_TYPES = ('float32', 'float16', 'int8')
+CHUNK_VALUES = 2**22 # float32 values of the largest intermediate array of a chunk
+
+LEAKY_RELU_SLOPE = 0.2 # Keras 'leaky_relu' default
+PIECEWISE_LINEAR = {'linear': 1.0, 'relu': 0.0, 'leaky_relu': LEAKY_RELU_SLOPE} # slope below 0
+MAX_TABLE_PIECES = 2**14
+
+
+def _activation(x, name):
+    if(name == 'linear'):
+        return x
+    if(name == 'relu'):
+        return np.maximum(x, 0, out=x)
+    if(name == 'leaky_relu'):
+        return np.maximum(x, LEAKY_RELU_SLOPE*x, out=x)
+    if(name == 'tanh'):
+        return np.tanh(x, out=x)
+    if(name == 'sigmoid'):
+        return 0.5*(1 + np.tanh(0.5*x))
+    if(name == 'softmax'):
+        x = np.exp(x - x.max(axis=-1, keepdims=True))
+        return x/x.sum(axis=-1, keepdims=True)
+    raise ValueError("Unsupported activation " + repr(name))
+
+
+def class_confidences(probabilities):
+    # (class, confidence) of every row of predictions: one sigmoid column (binary) or one column per class.
+    probabilities = np.asarray(probabilities, dtype=float)
+    if(probabilities.ndim == 1 or probabilities.shape[1] == 1):
+        probabilities = probabilities.reshape(-1)
+        classes = (probabilities >= 0.5).astype(np.int64)
+        return classes, np.where(classes == 1, probabilities, 1 - probabilities)
+    classes = np.argmax(probabilities, axis=1)
+    return classes, probabilities[np.arange(len(classes)), classes]
+
+
+def export_model(model, path, class_names=None, weights='float32'):
+    '''
+    Write a Keras model (or the path of a saved one) to a .npz file for NumpyClassifier, returns its configuration.
+    weights is one of WEIGHT_TYPES, int8 kernels are stored with a float32 scale for every output unit.
+    '''
+    if(weights not in WEIGHT_TYPES):
+        raise ValueError("weights must be one of " + str(WEIGHT_TYPES))
+    if(isinstance(model, str)):
+        import tensorflow as tf # optional, only needed to read Keras models
+        model = tf.keras.models.load_model(model)
+    config = {'version': VERSION, 'input_shape': [int(size) for size in model.input_shape[1:]],
+              'class_names': None if class_names is None else [str(name) for name in class_names],
+              'weights': weights, 'layers': []}
+    arrays = {}
+    for layer in model.layers:
+        kind = type(layer).__name__
+        if(kind in ('InputLayer', 'Dropout')): # dropout only acts while training
+            continue
+        if(kind == 'Flatten'):
+            config['layers'].append({'type': 'flatten'})
+        elif(kind == 'Activation'):
+            config['layers'].append({'type': 'activation', 'activation': layer.get_config()['activation']})
+        elif(kind == 'Dense'):
+            index = len(config['layers'])
+            kernel, *bias = layer.get_weights()
+            if(weights == 'int8'):
+                scale = np.abs(kernel).max(axis=0)/127
+                scale[scale == 0] = 1
+                arrays['kernel_' + str(index)] = np.round(kernel/scale).astype(np.int8)
+                arrays['scale_' + str(index)] = scale.astype(np.float32)
+            else:
+                arrays['kernel_' + str(index)] = kernel.astype(weights)
+            arrays['bias_' + str(index)] = (bias[0] if bias else np.zeros(kernel.shape[1])).astype(np.float32)
+            config['layers'].append({'type': 'dense', 'units': int(kernel.shape[1]),
+                                     'activation': layer.get_config()['activation']})
+        else:
+            raise ValueError("Unsupported layer " + layer.name + " (" + kind + ")")
+    table = _pixel_table(config, arrays)
+    if(table is not None):
+        config['table'] = table[0] # layers up to this Dense layer are replaced by the table
+        arrays.update(table_breaks=table[1], table_slopes=table[2], table_offsets=table[3])
+    np.savez(path, config=np.array(json.dumps(config)), **arrays)
+    return config
+
+
+def _pixel_table(config, arrays):
+    '''
+    (index of the first Dense layer after Flatten, piece boundaries, slopes, offsets) of the layers up to that
+    Dense layer without its bias, or None if they are not a piecewise linear function of every pixel value.
+    Slopes and offsets are (pieces, pixels, units) arrays, pieces are split at the sorted boundaries.
+    '''
+    shape = config['input_shape']
+    if(shape[-1] != 1 or 'flatten' not in [layer['type'] for layer in config['layers']]):
+        return None
+    # Linear pieces of the pixel function x -> x*slopes + offsets, split where an activation changes its slope.
+    breaks, slopes, offsets = np.zeros(0), np.ones((1, 1)), np.zeros((1, 1))
+    for index, layer in enumerate(config['layers']):
+        if(layer['type'] == 'flatten'):
+            break
+        if(layer['type'] == 'dense'):
+            kernel = _kernel(arrays, index)
+            slopes, offsets = slopes @ kernel, offsets @ kernel + arrays['bias_' + str(index)]
+        if(layer['activation'] not in PIECEWISE_LINEAR):
+            return None
+        if(layer['activation'] == 'linear'):
+            continue
+        with np.errstate(divide='ignore', invalid='ignore'):
+            crossings = -offsets/slopes
+        previous = breaks
+        low = np.concatenate(([-np.inf], previous))[:, None]
+        high = np.concatenate((previous, [np.inf]))[:, None]
+        breaks = np.unique(np.concatenate((previous, crossings[(crossings > low) & (crossings < high)])))
+        if(len(breaks) >= MAX_TABLE_PIECES):
+            return None
+        middle = np.concatenate(([breaks[0] - 1 if len(breaks) else 0], (breaks[:-1] + breaks[1:])/2,
+                                 [breaks[-1] + 1] if len(breaks) else []))
+        pieces = np.searchsorted(previous, middle) # piece before the split
+        slopes, offsets = slopes[pieces], offsets[pieces]
+        scale = np.where(middle[:, None]*slopes + offsets > 0, 1.0, PIECEWISE_LINEAR[layer['activation']])
+        slopes, offsets = slopes*scale, offsets*scale
+    head = index + 1
+    if(head == len(config['layers']) or config['layers'][head]['type'] != 'dense'):
+        return None
+    kernel = _kernel(arrays, head).reshape(int(np.prod(shape[:-1])), slopes.shape[1], -1)
+    return (head, breaks.astype(np.float32), np.einsum('kc,pcu->kpu', slopes, kernel).astype(np.float32),
+            np.einsum('kc,pcu->kpu', offsets, kernel).astype(np.float32))
+
+
+def _kernel(arrays, index):
+    # float64 kernel of a Dense layer as it is stored.
+    kernel = arrays['kernel_' + str(index)].astype(np.float64)
+    if('scale_' + str(index) in arrays):
+        kernel *= arrays['scale_' + str(index)]
+    return kernel
+
+
+class NumpyClassifier:
+    '''
+    Classifier exported by export_model. predict(rois) gives the class probabilities of a (N, h, w) or
+    (N, *input_shape) stack of normalised ROIs like Keras model.predict, so it can replace a Keras model
+    (e.g. in classifyEmitters). Layers are applied to chunks of ROIs whose intermediate arrays have at most
+    CHUNK_VALUES values.
+    '''
+    def __init__(self, path):
+        with np.load(path, allow_pickle=False) as data:
+            self.config = json.loads(str(data['config']))
+            self.layers = []
+            for index, layer in enumerate(self.config['layers']):
+                if(layer['type'] == 'dense'):
+                    # Weights are converted to float32 once, for BLAS products.
+                    kernel = data['kernel_' + str(index)].astype(np.float32)
+                    if('scale_' + str(index) in data):
+                        kernel *= data['scale_' + str(index)]
+                    layer = dict(layer, kernel=kernel, bias=data['bias_' + str(index)])
+                self.layers.append(layer)
+            self.table = None
+            if('table' in self.config):
+                # (piece*pixels + pixel, slopes and offsets of the units) rows, gathered with one take.
+                pieces, pixels, units = data['table_slopes'].shape
+                self.table = (data['table_breaks'], np.concatenate((data['table_slopes'], data['table_offsets']),
+                                                                   axis=2).reshape(pieces*pixels, 2*units))
+        self.input_shape = tuple(self.config['input_shape'])
+        self.class_names = self.config['class_names']
+        # Upper bound of the values of one ROI in an intermediate array: pixels times the widest Dense layer,
+        # with a table only the (pixels, units) rows of the Dense layer after Flatten.
+        pixels = int(np.prod(self.input_shape[:-1]))
+        if(self.table is None):
+            self._widest = pixels*max([self.input_shape[-1]] + [layer['units'] for layer in self.layers
+                                                                if layer['type'] == 'dense'])
+        else:
+            self._widest = pixels*self.table[1].shape[1]
+
+    def _forward(self, x):
+        # x: (N, pixels, channels), every Dense layer before Flatten is one (N*pixels, units) product.
+        layers = self.layers
+        if(self.table is not None):
+            breaks, table = self.table
+            x = x[..., 0]
+            rows = np.take(table, np.searchsorted(breaks, x)*x.shape[1] + np.arange(x.shape[1]), axis=0)
+            head = self.layers[self.config['table']]
+            units = table.shape[1]//2
+            x = (x[:, None, :] @ rows[..., :units]) + rows[..., units:].sum(axis=1, keepdims=True) + head['bias']
+            x = _activation(x, head['activation'])
+            layers = self.layers[self.config['table'] + 1:]
+        for layer in layers:
+            if(layer['type'] == 'flatten'):
+                x = x.reshape(len(x), 1, -1)
+            elif(layer['type'] == 'dense'):
+                x = (x.reshape(-1, x.shape[-1]) @ layer['kernel']).reshape(x.shape[:-1] + (-1,))
+                x += layer['bias']
+                x = _activation(x, layer['activation'])
+            else:
+                x = _activation(x, layer['activation'])
+        return x.reshape(len(x), -1) if x.shape[1] == 1 else x
+
+    def predict(self, rois, batch_size=None):
+        # Class probabilities, (N, classes). batch_size (default: from CHUNK_VALUES) is the amount of ROIs per chunk.
+        rois = np.asarray(rois, dtype=np.float32).reshape((-1,) + self.input_shape)
+        x = rois.reshape(len(rois), -1, self.input_shape[-1])
+        batch_size = batch_size or max(1, CHUNK_VALUES//self._widest)
+        if(len(x) <= batch_size):
+            return self._forward(x)
+        return np.concatenate([self._forward(x[start:start + batch_size]) for start in range(0, len(x), batch_size)])
+
+
+def parity_check(model, classifier, rois, tolerance=1e-4, labels=None, accuracy_tolerance=0.01):
+    '''
+    Compare the predictions of a Keras model and a NumpyClassifier (or their paths) on ROIs, e.g. the test frames
+    of a packed dataset. Returns a dict with the largest probability difference, the fraction of ROIs given the
+    same class and whether the difference is within tolerance (use about 1e-2 for float16 and int8 weights).
+    With labels, the accuracies of both are compared as well and may differ by at most accuracy_tolerance.
+    '''
+    if(isinstance(model, str)):
+        import tensorflow as tf # optional, only needed to read Keras models
+        model = tf.keras.models.load_model(model)
+    if(isinstance(classifier, str)):
+        classifier = NumpyClassifier(classifier)
+    rois = np.asarray(rois, dtype=np.float32).reshape((-1,) + classifier.input_shape)
+    expected = np.asarray(model.predict(rois, verbose=0)).reshape(len(rois), -1)
+    predicted = classifier.predict(rois)
+    expectedClasses, predictedClasses = class_confidences(expected)[0], class_confidences(predicted)[0]
+    difference = float(np.max(np.abs(expected - predicted))) if len(rois) else 0.0
+    result = {'rois': len(rois), 'max_difference': difference,
+              'class_agreement': float(np.mean(expectedClasses == predictedClasses)) if len(rois) else 1.0,
+              'passed': difference <= tolerance}
+    if(labels is not None and len(rois)):
+        labels = np.asarray(labels).reshape(-1)
+        result['keras_accuracy'] = float(np.mean(expectedClasses == labels))
+        result['numpy_accuracy'] = float(np.mean(predictedClasses == labels))
+        result['passed'] &= abs(result['keras_accuracy'] - result['numpy_accuracy']) <= accuracy_tolerance
+    return result
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Export a Keras emitter classifier for TensorFlow free inference.")
+    parser.add_argument('model', help="saved Keras model")
+    parser.add_argument('output', help="exported .npz file")
+    parser.add_argument('--classes', nargs='+', help="colour names in label order")
+    parser.add_argument('--weights', default='float32', choices=WEIGHT_TYPES)
+    parser.add_argument('--check',
+                        help="packed dataset (see packedDataset) whose frames and labels are used for a parity check")
+    parser.add_argument('--tolerance', type=float, help="largest allowed probability difference of the check")
+    args = parser.parse_args()
+
+    import tensorflow as tf
+    model = tf.keras.models.load_model(args.model)
+    config = export_model(model, args.output, args.classes, args.weights)
+    print("Exported", len(config['layers']), "layers with", args.weights, "weights to", args.output)
+    if(args.check):
+        from packedDataset import PackedDataset
+        dataset = PackedDataset(args.check)
+        tolerance = args.tolerance or (1e-4 if args.weights == 'float32' else 1e-2)
+        rois, labels = dataset.take(np.arange(len(dataset)))
+        result = parity_check(model, NumpyClassifier(args.output), rois, tolerance, labels)
+        print(result)
+        if(not result['passed']):
+            raise SystemExit("Exported classifier differs from the Keras model by more than " + str(tolerance))
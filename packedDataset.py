@@ -0,0 +1,174 @@
+'''
+Packed training dataset of emitter frames for the classification notebooks.
+
+One file holds all colours: a JSON header (colours, their labels, source files and frame ranges) followed by a
+contiguous float32 (N, ROIsize, ROIsize) frame array and an int8 label array, both 64 byte aligned so they can be
+memory-mapped. PackedDataset opens a file without reading the data, shuffles and splits with index permutations
+and only reads the frames of the indices it is asked for.
+
+    python packedDataset.py dataset.emitters 605=e605lp3_go.tiff 655=e655lp3_go.tiff,e655_2lp3_go.tiff [--normalisation spectral]
+'''
+import argparse
+from datetime import datetime, timezone
+import json
+import os
+import struct
+
+import numpy as np
+
+from movieReader import TiffMovieReader
+
+
+MAGIC = b'EMITPACK'
+VERSION = 1
+ALIGNMENT = 64
+
+
+def _align(offset):
+    return -(-offset//ALIGNMENT)*ALIGNMENT
+
+
+def frame_shape(readers):
+    # Frame shape shared by all emitter files (movieReader.TiffMovieReaders) of a dataset.
+    if(not readers):
+        raise ValueError("No emitter files given")
+    shapes = {reader.shape[1:] for reader in readers}
+    if(len(shapes) != 1):
+        raise ValueError("All files must have frames of the same shape, found " + str(sorted(shapes)))
+    return shapes.pop()
+
+
+def write_packed_dataset(path, colours, normalisation=None, chunk_size=4096):
+    '''
+    Pack emitter Tiff files into one dataset file. colours is a list of (colour name, [Tiff paths]) pairs,
+    the label of a colour is its position in the list. Files are read and written chunk_size frames at a time,
+    so memory use does not depend on the dataset size.
+    normalisation (None or a scaleEmitters.NORMALISATION_MODES mode) scales raw emitter files while packing,
+    files which are already scaled (scaleEmitters output) are packed as they are.
+    Returns the header of the file.
+    '''
+    if(normalisation is not None):
+        from scaleEmitters import normalize_frames
+    readers = [[TiffMovieReader(file) for file in files] for _, files in colours]
+    try:
+        ROIshape = frame_shape([reader for colourReaders in readers for reader in colourReaders])
+        header = {'version': VERSION, 'roi_shape': list(ROIshape), 'normalisation': normalisation,
+                  'created': datetime.now(timezone.utc).isoformat(timespec='seconds'), 'colours': []}
+        start = 0
+        for label, ((name, files), colourReaders) in enumerate(zip(colours, readers)):
+            count = sum(len(reader) for reader in colourReaders)
+            header['colours'].append({'name': str(name), 'label': label, 'start': start, 'stop': start + count,
+                                      'count': count, 'files': [{'path': os.path.abspath(file), 'frames': len(reader)}
+                                                                for file, reader in zip(files, colourReaders)]})
+            start += count
+        header['count'] = start
+        imageBytes = start*int(np.prod(ROIshape))*4
+
+        # The header is padded up to the aligned frame array, whose offset is part of the header itself.
+        offset = 0
+        while(True):
+            header['images_offset'] = offset
+            header['labels_offset'] = _align(offset + imageBytes)
+            text = json.dumps(header).encode()
+            if(_align(len(MAGIC) + 4 + len(text)) <= offset):
+                break
+            offset = _align(len(MAGIC) + 4 + len(text))
+
+        temporary = path + '.tmp'
+        with open(temporary, 'wb') as f:
+            f.write(MAGIC + struct.pack('<I', offset - len(MAGIC) - 4) + text.ljust(offset - len(MAGIC) - 4))
+            for colourReaders in readers:
+                for reader in colourReaders:
+                    for chunk in range(0, len(reader), chunk_size):
+                        frames = reader.read_range(chunk, chunk + chunk_size)
+                        if(normalisation is not None):
+                            frames = normalize_frames(frames, normalisation)
+                        f.write(np.ascontiguousarray(frames, dtype='<f4').tobytes())
+            f.write(b'\0'*(header['labels_offset'] - offset - imageBytes))
+            for colour in header['colours']:
+                f.write(np.full(colour['count'], colour['label'], dtype=np.int8).tobytes())
+        os.replace(temporary, path)
+    finally:
+        for colourReaders in readers:
+            for reader in colourReaders:
+                reader.close()
+    return header
+
+
+class PackedDataset:
+    '''
+    Memory-mapped packed dataset (see write_packed_dataset).
+    images is a read-only (N, ROIsize, ROIsize) float32 memmap and labels an int8 memmap, nothing is read until
+    they are indexed. colours lists every colour with its label, frame range and source files.
+    Shuffle and split with permutation and split, which only give index arrays, then read the frames of an
+    index array with take (all at once, e.g. for model.fit) or batches (batch by batch).
+    '''
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as f:
+            if(f.read(len(MAGIC)) != MAGIC):
+                raise ValueError(path + " is not a packed emitter dataset")
+            length, = struct.unpack('<I', f.read(4))
+            self.header = json.loads(f.read(length))
+        self.colours = self.header['colours']
+        shape = (self.header['count'],) + tuple(self.header['roi_shape'])
+        if(self.header['count'] == 0):
+            self.images = np.zeros(shape, dtype=np.float32)
+            self.labels = np.zeros(0, dtype=np.int8)
+        else:
+            self.images = np.memmap(path, dtype='<f4', mode='r', offset=self.header['images_offset'], shape=shape)
+            self.labels = np.memmap(path, dtype=np.int8, mode='r', offset=self.header['labels_offset'],
+                                    shape=shape[:1])
+
+    def __len__(self):
+        return self.header['count']
+
+    @property
+    def class_names(self):
+        return [colour['name'] for colour in self.colours]
+
+    def permutation(self, seed=None):
+        # Shuffled indices of all frames.
+        return np.random.default_rng(seed).permutation(len(self))
+
+    def split(self, test_size=0.2, seed=None, stratify=False):
+        # Shuffled (train indices, test indices), with stratify every colour is split in the same proportion.
+        rng = np.random.default_rng(seed)
+        if(not stratify):
+            index = rng.permutation(len(self))
+            testCount = int(np.ceil(test_size*len(self)))
+            return index[testCount:], index[:testCount]
+        train, test = [], []
+        for colour in self.colours:
+            index = colour['start'] + rng.permutation(colour['count'])
+            testCount = int(np.ceil(test_size*colour['count']))
+            train.append(index[testCount:])
+            test.append(index[:testCount])
+        return rng.permutation(np.concatenate(train)), rng.permutation(np.concatenate(test))
+
+    def take(self, index):
+        # (frames, labels) of index in index order, the file is read in frame order.
+        index = np.asarray(index, dtype=np.int64)
+        order = np.argsort(index, kind='stable')
+        images = np.empty((len(index),) + self.images.shape[1:], dtype=np.float32)
+        labels = np.empty(len(index), dtype=np.int8)
+        images[order] = self.images[index[order]]
+        labels[order] = self.labels[index[order]]
+        return images, labels
+
+    def batches(self, index, batch_size=64):
+        # Generator of (frames, labels) batches of index.
+        for start in range(0, len(index), batch_size):
+            yield self.take(index[start:start + batch_size])
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Pack emitter Tiff files of several colours into one dataset file.")
+    parser.add_argument('output', help="dataset file")
+    parser.add_argument('colours', nargs='+', help="colour=file.tiff[,file2.tiff...], labels follow this order")
+    parser.add_argument('--normalisation', help="scale raw emitter files, see scaleEmitters.NORMALISATION_MODES")
+    args = parser.parse_args()
+    header = write_packed_dataset(args.output, [(colour.split('=', 1)[0], colour.split('=', 1)[1].split(','))
+                                                for colour in args.colours], args.normalisation)
+    for colour in header['colours']:
+        print(colour['label'], colour['name'], colour['count'], "frames")
@@ -1,11 +1,23 @@
-import matplotlib.pyplot as plt
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import copy
+import csv
+import os
+import warnings
+
 import numpy as np
-from PIL import Image, ImageFilter
-import skimage.io
-from scipy.ndimage import gaussian_filter
-from skimage.feature import peak_local_max
 import tifffile
 
+from calibrationProfiles import PROFILE_PARAMETERS, PROFILE_SETTINGS, CalibrationProfileStore
+from calibrationStats import CalibrationStats
+from emitterDetection import DoGDetector
+from emitterBuffer import EmitterBuffer
+from emitterFeatures import FEATURE_DTYPE, gather_rois, inside_border, roi_features
+from emitterLocalisation import (LOCALISATION_DTYPE, LOCALISATION_METHODS, LOCALISED_FEATURE_DTYPE, PIXEL_CENTRE,
+                                 localise, recentre_rois)
+from movieReader import TiffMovieReader
+from stageProfiler import StageProfiler, timed
+
 
 class EmitterMovie:
     '''
@@ -24,6 +36,27 @@ class EmitterMovie:
 
     Use use_input_parameter_vals set to False to infer acceptance ranges.
     Test_emitter_list_length set the amount of emitters used for inference.
+    Set single_pass to True to detect emitters only once when inferring acceptance ranges: candidate ROIs and
+    their features are stored in a feature table (extract_features) which is used for both inference and filtering.
+    Calibration_sampling chooses the frames used for inference: 'first' (frames from the start of the movie),
+    'stride' (frames spread evenly over the whole movie) or 'random' (random frames, seeded by calibration_seed).
+    Spreading the calibration frames avoids bias from photobleaching at the start of a movie.
+    Reading stops as soon as enough emitters are found, frames_read counts the frames which were actually detected.
+    Detection_backend chooses how frames are DoG filtered, see emitterDetection.DoGDetector ('reference' is exact,
+    'separable' and 'fft' are faster float32 backends).
+    Feature_cache (a featureCache.FeatureCache) stores detected candidates of whole movies on disk, so movies are
+    detected only once while edge/peak thresholds and acceptance ranges are tuned.
+    Edge_value_multiplier scales the threshold for emitter intensity on the ROI edges (low intensity profile uses 2).
+    Calibration statistics are accumulated in calibration_stats (a calibrationStats.CalibrationStats) as calibration
+    emitters are found, without keeping their features. They carry over to following movies and can be saved,
+    loaded (pass them as calibration_stats to continue from them) or merged with those of other EmitterMovies.
+    Save_calibration_profile stores the acceptance ranges with their provenance under a name (e.g. per objective, colour
+    and filter setup), load_calibration_profile uses a stored profile for new acquisitions and skips calibration.
+    Profiler (a stageProfiler.StageProfiler) records time per processing stage and rejections per acceptance
+    criterion, profiling is off by default.
+    Localisation ('centroid' or 'gaussian', see emitterLocalisation) finds the sub-pixel position, PSF widths and
+    photons of accepted emitters, stored with their features in movie_emitter_list.metadata (save_emitter_table
+    writes them as CSV). With recentre_rois the saved ROIs are resampled so the localised position is their centre.
 
     Create EmitterMovie object with desired parameters. 
     Use add_to_list to get single emitters from input file.
@@ -31,15 +64,27 @@ class EmitterMovie:
     '''
     def __init__(self, colour, GaussianFiltersigma1, GaussianFiltersigma2, ROIradius, BorderRegion, emitter_list_length, test_emitter_list_length, 
                 edge_peak_threshold_value, use_input_parameter_vals, xinvmag_mean, xinvmag_stddev, yinvmag_mean, yinvmag_stddev,
-                ellipticity_mean, ellipticity_stddev, median_IntensityRange, stddev_IntensityRange):
+                ellipticity_mean, ellipticity_stddev, median_IntensityRange, stddev_IntensityRange,
+                edge_value_multiplier=1, single_pass=False, calibration_sampling='first', calibration_seed=None,
+                detection_backend='reference', feature_cache=None, profiler=None, calibration_stats=None,
+                localisation=None, recentre_rois=False):
         self.colour = colour
-        self.movie_emitter_list = [] 
+        if(localisation is not None and localisation not in LOCALISATION_METHODS):
+            raise ValueError("localisation must be None or one of " + str(LOCALISATION_METHODS))
+        self.localisation = localisation
+        self.recentre_rois = recentre_rois
+        # accepted ROIs and their features
+        self.movie_emitter_list = EmitterBuffer(emitter_list_length, ROIradius*2 + 1,
+                                                FEATURE_DTYPE if localisation is None else LOCALISED_FEATURE_DTYPE)
         self.GaussianFiltersigma1 = GaussianFiltersigma1 
         self.GaussianFiltersigma2 = GaussianFiltersigma2
+        self.detector = DoGDetector(GaussianFiltersigma1, GaussianFiltersigma2, detection_backend)
         self.ROIradius = ROIradius
         self.BorderRegion = BorderRegion
         self.emitter_list_length = emitter_list_length
         self.edge_peak_threshold_value = edge_peak_threshold_value #default 3, use lower value to be more selective.
+        self.edge_value_multiplier = edge_value_multiplier # edge threshold = edge_value_multiplier * ROI peak threshold
+        self.single_pass = single_pass
         self.total_emitters_processed = 0
         self.good_emitters_added = 0
 
@@ -54,172 +99,289 @@ class EmitterMovie:
         self.IntensityRange_stddev = stddev_IntensityRange
 
         self.test_emitter_list_length = test_emitter_list_length # Default 1000
-        self.test_emitter_list = 0
+        self.calibration_stats = CalibrationStats() if calibration_stats is None else calibration_stats
+        self.test_emitter_list = self.calibration_stats.count
+        self.calibration_sources = [] # {'movie': path, 'emitters': amount} of movies used for calibration
+        if(calibration_sampling not in ('first', 'stride', 'random')):
+            raise ValueError("calibration_sampling must be 'first', 'stride' or 'random'")
+        self.calibration_sampling = calibration_sampling
+        self.calibration_seed = calibration_seed
+        self.frames_read = 0 # frames detected for calibration and filtering
+        self.feature_cache = feature_cache
+        self.profiler = profiler
+
+    def _chunk_features(self, stack, frames):
+        # Feature table rows and ROIs for all candidate emitters of a stack of frames (frames are their
+        # movie frame numbers), computed in one batch.
+        # For each frame get location of peak intensity values with the DoG detector,
+        # remove emitters close to edge region due to differing intensity values
+        framePeaks = self.detector.find_peaks(stack, self.profiler)
+        with timed(self.profiler, 'border_filter'):
+            framePeaks = [peaks[inside_border(peaks, stack.shape[1:], self.BorderRegion)] for peaks in framePeaks]
+            index = np.repeat(np.arange(len(framePeaks)), [len(peaks) for peaks in framePeaks])
+            localpeaks = np.concatenate(framePeaks + [np.zeros((0, 2), dtype=np.intp)])
+        # Extract the ROIs - we know they are centered around the localpeaks positions, with radius ROIradius
+        with timed(self.profiler, 'roi_gather', len(localpeaks)):
+            rois = gather_rois(stack, np.column_stack((index, localpeaks)), self.ROIradius)
+        if(self.profiler is not None):
+            self.profiler.add_items('border_filter', len(localpeaks))
+        return self._feature_table(np.asarray(frames)[index], localpeaks, rois), rois
+
+    def _feature_table(self, frames, localpeaks, rois):
+        # Feature table of candidate ROIs at (frame, y, x) positions frames, localpeaks.
+        features = np.zeros(len(localpeaks), dtype=FEATURE_DTYPE)
+        features['frame'] = frames
+        features['y'] = localpeaks[:, 0]
+        features['x'] = localpeaks[:, 1]
+        with timed(self.profiler, 'roi_features', len(rois)):
+            (features['mean_intensity'], features['xinvmag'], features['yinvmag'], features['ellipticity'],
+                features['edge_ok'], features['single_peak']) = roi_features(rois, self.edge_peak_threshold_value,
+                                                                             self.edge_value_multiplier, self.profiler)
+        return features
+
+    def _frame_features(self, singleFrame, frame):
+        return self._chunk_features(singleFrame[np.newaxis], [frame])
+
+    def _read_frame(self, movie, frame):
+        with timed(self.profiler, 'tiff_read', 1):
+            return movie[frame]
+
+    def _set_parameters(self):
+        # Acceptance ranges from the calibration statistics: median of mean intensity, mean of x,y inverse
+        # Fourier magnitudes and ellipticities, each with 1 standard deviation.
+        print("Test movie length:", self.test_emitter_list, "\n")
+        (self.xinvmag_mean, self.xinvmag_stddev, self.yinvmag_mean, self.yinvmag_stddev, self.ellipticity_mean,
+            self.ellipticity_stddev, self.IntensityRange_median, self.IntensityRange_stddev) = self.calibration_stats.parameters()
+        for value in (self.IntensityRange_median, self.IntensityRange_stddev, self.xinvmag_mean, self.xinvmag_stddev,
+                      self.yinvmag_mean, self.yinvmag_stddev, self.ellipticity_mean, self.ellipticity_stddev):
+            print(value)
+
+    def calibration_order(self, length):
+        # Order in which frames of a movie of length frames are visited for calibration.
+        # 'stride' visits frames coarse to fine (0, length/2, length/4, 3*length/4, ...), so any amount
+        # of calibration frames is spread evenly over the movie.
+        if(self.calibration_sampling == 'random'):
+            return np.random.default_rng(self.calibration_seed).permutation(length)
+        if(self.calibration_sampling == 'stride'):
+            step = 1
+            while(step < length):
+                step *= 2
+            visited = np.zeros(length, dtype=bool)
+            order = []
+            while(step >= 1):
+                frames = np.arange(0, length, step)
+                frames = frames[~visited[frames]]
+                visited[frames] = True
+                order.append(frames)
+                step //= 2
+            return np.concatenate(order)
+        return np.arange(length)
+
+    def _calibrate(self, movie, cache=None):
+        # Infer acceptance ranges from frames in calibration order, stop reading once
+        # test_emitter_list_length emitters pass the edge and single peak checks.
+        # Detected frames are stored in cache (a dict) if given, so they can be filtered without detecting them again.
+        framesRead = 0
+        for frame in self.calibration_order(len(movie)):
+            if(self.test_emitter_list >= self.test_emitter_list_length): # specific movie length
+                break
+            features, rois = self._frame_features(self._read_frame(movie, frame), frame)
+            framesRead += 1
+            if(cache is not None):
+                cache[frame] = features, rois
+            self.add_calibration_features(features, movie.path)
+        self.frames_read += framesRead
+        print("Calibration frames read:", framesRead, "of", len(movie))
+        self._set_parameters()
 
     def get_parameters(self, path):
         # read image
-        intensities = []
-        xinvmags = []
-        yinvmags = []
-        ellipticities = []
-
-        image = skimage.io.imread(path)
-        for frame in range(0, image.shape[0]):
-            if(self.test_emitter_list < self.test_emitter_list_length): # specific movie length
-                # For each frame get location of peak intensity values.
-                # Get minimum value for threshold intensity using gaussian filters.
-                # Values above threshold will be classed as emitter locations.
-                singleFrame = image[frame, :, :]
-                Gauss1FilteredImage = gaussian_filter(
-                    singleFrame, sigma=self.GaussianFiltersigma1).astype(float)
-                Gauss2FilteredImage = gaussian_filter(
-                    singleFrame, sigma=self.GaussianFiltersigma2).astype(float)
-                DoGFilteredImage = Gauss1FilteredImage-Gauss2FilteredImage
-                MinValueLocalMax = np.std(DoGFilteredImage)*2
-                localpeaks = peak_local_max(
-                        DoGFilteredImage, threshold_abs=MinValueLocalMax)
-
-                # remove emitters close to edge region due to differing intensity values
-                markForDeletion = []
-                for i in range(0, localpeaks.shape[0]):
-                    if (localpeaks[i][0] <= (self.BorderRegion+1)) \
-                                or (localpeaks[i][0] >= singleFrame.shape[0]-(self.BorderRegion+1)) \
-                                or (localpeaks[i][1] <= (self.BorderRegion+1)) \
-                                or (localpeaks[i][1] >= singleFrame.shape[1]-(self.BorderRegion+1)):
-                            markForDeletion = np.append(markForDeletion, i)
-
-                markForDeletion = np.int_(markForDeletion)
-                localpeaks = np.delete(localpeaks, markForDeletion, axis=0)
-
-                # Extract the ROI - we know it is centered around the localpeaks[l,:] position, with radius ROIradius
-                for l in range(0, len(localpeaks)):
-                    ROI = singleFrame[localpeaks[l, 0]-self.ROIradius:localpeaks[l, 0]+self.ROIradius+1,
-                                          localpeaks[l, 1]-self.ROIradius:localpeaks[l, 1]+self.ROIradius+1]
-                    # Define image parameters, x,y inverse fourier magnitude, intensity.
-                    ROI_F = np.fft.fft2(ROI)
-                    xmagnitude = np.abs(ROI_F[0, 1])
-                    xinvmag = 1/xmagnitude
-                    ymagnitude = np.abs(ROI_F[1, 0])
-                    yinvmag = 1/ymagnitude
-
-                    # Check for ellipticity by comparing inverse Fourier magnitudes
-                    # Resulting ellipticity should be less than ellipticity_cval
-                    calculated_ellipticity = xinvmag - yinvmag
-                    MinValueLocalMaxR = np.std(ROI)*self.edge_peak_threshold_value
-
-                    # Check for multiple emitter peaks in single image and on edges with specific edgevalue. 
-                    ROIpeaks = peak_local_max(ROI, threshold_abs = MinValueLocalMaxR)
-                    edgeValue = MinValueLocalMaxR
-                    meanIntensityvalue = np.sum(ROI)/((self.ROIradius*2 + 1)**2)
-
-                    # Check image intensity parameters with ideal image parameters and desired tiff file length.
-                    if(self.test_emitter_list < self.test_emitter_list_length): # specific movie length
-                        if((np.all(ROI[:, 0] < edgeValue)) and (np.all(ROI[:, self.ROIradius*2] < edgeValue)) and (np.all(ROI[0, :] < edgeValue)) and (np.all(ROI[self.ROIradius*2, :] < edgeValue))):
-                            if(len(ROIpeaks) == 1): #amount of emitter peaks in ROI    
-                                # if correct parameters adds to list
-                                intensities.append(meanIntensityvalue)
-                                xinvmags.append(xinvmag)
-                                yinvmags.append(yinvmag)
-                                ellipticities.append(calculated_ellipticity)
-                                self.test_emitter_list += 1
-                                # Stop appending if list length is reached.
-        print("Test movie length:", self.test_emitter_list, "\n")
-        self.IntensityRange_median = np.median(intensities)
-        print(self.IntensityRange_median)
-        self.IntensityRange_stddev = np.std(intensities)          
-        print(self.IntensityRange_stddev)
-        
-        self.xinvmag_mean = np.mean(xinvmags)            
-        print(self.xinvmag_mean)
-        
-        self.xinvmag_stddev = np.std(xinvmags)
-        print(self.xinvmag_stddev)
-        
-        self.yinvmag_mean = np.mean(yinvmags)
-        print(self.yinvmag_mean)
-        
-        self.yinvmag_stddev = np.std(yinvmags)
-        print(self.yinvmag_stddev)
-        self.ellipticity_mean = np.mean(ellipticities)
-        print(self.ellipticity_mean)
-        
-        self.ellipticity_stddev = np.std(ellipticities)
-        print(self.ellipticity_stddev)
-    
-    
-    
-    def add_to_list(self, path):
-        if(self.use_input_parameter_vals == False):
-            # If false updates parameters by 
-            self.get_parameters(path)
+        with TiffMovieReader(path) as movie:
+            self._calibrate(movie)
+
+    def extract_features(self, path, frames=None, batch_frames=32):
+        # Detect every candidate ROI of a movie once and store its features in a table
+        # (one row per candidate, in frame then peak order) with a parallel ROI array.
+        # Calibration and filtering are then selections on this table, see process_movies.
+        # frames (a range of consecutive frames) limits extraction to part of the movie, only those frames are read.
+        # ROI features are computed batch_frames frames at a time.
+        # With a feature_cache, candidates of whole movies are stored on disk and only detected the first time.
+        features, rois, _ = self._movie_features(path, frames, batch_frames)
+        return features, rois
+
+    def _movie_features(self, path, frames=None, batch_frames=32):
+        # extract_features and the movie length, which comes from the cache on cache hits (the movie is not opened).
+        if(self.feature_cache is not None and frames is None):
+            cached = self.feature_cache.load(path, self.detection_parameters())
+            if(cached is not None):
+                cachedFrames, localpeaks, rois, length = cached
+                return self._feature_table(cachedFrames, localpeaks, rois), rois, length
+        size = self.ROIradius*2 + 1
+        with TiffMovieReader(path) as movie:
+            frames = range(0, len(movie)) if frames is None else frames
+            chunkFeatures = []
+            for chunk in (frames[i:i + batch_frames] for i in range(0, len(frames), batch_frames)):
+                with timed(self.profiler, 'tiff_read', len(chunk)):
+                    stack = movie.read_range(chunk.start, chunk.stop)
+                chunkFeatures.append(self._chunk_features(stack, chunk))
+            self.frames_read += len(frames) # not for cache hits, which read no frames
+            features = np.concatenate([f for f, _ in chunkFeatures] + [np.zeros(0, dtype=FEATURE_DTYPE)])
+            rois = np.concatenate([r for _, r in chunkFeatures] + [np.zeros((0, size, size), dtype=movie.dtype)])
+            if(self.feature_cache is not None and len(frames) == len(movie)):
+                self.feature_cache.store(path, self.detection_parameters(), features['frame'],
+                                         np.column_stack((features['y'], features['x'])), rois, len(movie))
+            return features, rois, len(movie)
+
+    def detection_parameters(self):
+        # Parameters which change the detected candidates, used as feature cache key.
+        return {'GaussianFiltersigma1': float(self.GaussianFiltersigma1),
+                'GaussianFiltersigma2': float(self.GaussianFiltersigma2),
+                'detection_backend': self.detector.backend,
+                'BorderRegion': int(self.BorderRegion), 'ROIradius': int(self.ROIradius)}
+
+    def add_calibration_features(self, features, source=None):
+        # Add feature table rows which pass the edge and single peak checks to the calibration statistics,
+        # until there are test_emitter_list_length calibration emitters. source is the movie they come from.
+        candidates = features[features['edge_ok'] & features['single_peak']]
+        candidates = candidates[:max(self.test_emitter_list_length - self.test_emitter_list, 0)]
+        self.calibration_stats.update(candidates)
+        self.test_emitter_list += len(candidates)
+        if(source is not None and len(candidates)):
+            if(self.calibration_sources and self.calibration_sources[-1]['movie'] == source):
+                self.calibration_sources[-1]['emitters'] += len(candidates)
+            else:
+                self.calibration_sources.append({'movie': source, 'emitters': len(candidates)})
+
+    def get_parameters_from_features(self, features, source=None):
+        # Same acceptance range inference as get_parameters, using the first test_emitter_list_length
+        # candidates of the feature table which pass the edge and single peak checks.
+        # The table must be in calibration order, see calibration_rows.
+        self.add_calibration_features(features, source)
+        self._set_parameters()
+
+    def save_calibration_profile(self, name, store=None):
+        # Store the acceptance ranges, calibration statistics and source movies as a named profile
+        # in store (a calibrationProfiles.CalibrationProfileStore, default ./calibration_profiles).
+        store = CalibrationProfileStore() if store is None else store
+        return store.save(name, {key: getattr(self, key) for key in PROFILE_PARAMETERS},
+                          {key: getattr(self, key) for key in PROFILE_SETTINGS},
+                          self.calibration_stats, self.calibration_sources)
+
+    def load_calibration_profile(self, name, store=None):
+        # Use the acceptance ranges of a stored profile, following movies are not used for calibration.
+        store = CalibrationProfileStore() if store is None else store
+        entry, self.calibration_stats = store.load(name)
+        different = [key for key in PROFILE_SETTINGS if entry['settings'].get(key) != getattr(self, key)]
+        if(different):
+            warnings.warn("Calibration profile " + name + " was made with different " + ", ".join(different))
+        for key, value in entry['parameters'].items():
+            setattr(self, key, value)
+        self.test_emitter_list = self.calibration_stats.count
+        self.calibration_sources = [dict(source) for source in entry['sources']]
+        self.use_input_parameter_vals = True
+        return entry
+
+    def calibration_rows(self, features, length):
+        # Feature table rows of a movie of length frames reordered by calibration_order (stable within a frame).
+        if(self.calibration_sampling == 'first'):
+            return features
+        rank = np.empty(length, dtype=np.int64)
+        rank[self.calibration_order(length)] = np.arange(length)
+        return features[np.argsort(rank[features['frame']], kind='stable')]
+
+    def acceptance_criteria(self, features):
+        # Boolean masks of feature table rows passing each acceptance criterion (see stageProfiler.CRITERIA).
+        intensity = features['mean_intensity']
+        ellipticity = features['ellipticity']
+        xinvmag = features['xinvmag']
+        yinvmag = features['yinvmag']
+        return {'intensity': (self.IntensityRange_median - self.IntensityRange_stddev < intensity)
+                             & (intensity < self.IntensityRange_median + self.IntensityRange_stddev),
+                'edge': features['edge_ok'],
+                'multi_peak': features['single_peak'],
+                'ellipticity': (self.ellipticity_mean - self.ellipticity_stddev < ellipticity)
+                               & (ellipticity < self.ellipticity_mean + self.ellipticity_stddev),
+                'xinvmag': (self.xinvmag_mean - self.xinvmag_stddev < xinvmag)
+                           & (xinvmag < self.xinvmag_mean + self.xinvmag_stddev),
+                'yinvmag': (self.yinvmag_mean - self.yinvmag_stddev < yinvmag)
+                           & (yinvmag < self.yinvmag_mean + self.yinvmag_stddev)}
+
+    def acceptance_mask(self, features):
+        # Boolean mask of feature table rows within all acceptance ranges.
+        return np.logical_and.reduce(list(self.acceptance_criteria(features).values()))
+
+    def add_features_to_list(self, features, rois):
+        # Masked selection equivalent to the frame loop in add_to_list: frames are consumed
+        # until the emitter list is full, every candidate in a consumed frame counts as processed.
+        remaining = self.emitter_list_length - len(self.movie_emitter_list)
+        if(remaining <= 0 or len(features) == 0):
+            return
+        with timed(self.profiler, 'acceptance', len(features)):
+            criteria = self.acceptance_criteria(features)
+            accepted = np.flatnonzero(np.logical_and.reduce(list(criteria.values())))[:remaining]
+        if(len(accepted) == remaining):
+            processed = features['frame'] <= features['frame'][accepted[-1]]
+        else:
+            processed = np.ones(len(features), dtype=bool)
+        self.total_emitters_processed += int(np.count_nonzero(processed))
+        if(self.profiler is not None):
+            self.profiler.add_rejections({name: passing[processed] for name, passing in criteria.items()})
+        rois, features = rois[accepted], features[accepted]
+        if(self.localisation is not None):
+            rois, features = self.localise_emitters(rois, features)
+        self.movie_emitter_list.extend(rois, features)
+        self.good_emitters_added += len(accepted)
+
+    def localise_emitters(self, rois, features):
+        # Accepted ROIs (recentred with recentre_rois) and their feature table rows with localisations.
+        with timed(self.profiler, 'localisation', len(rois)):
+            localisations = localise(rois, self.localisation, np.column_stack((features['y'], features['x'])))
+            rows = np.zeros(len(features), dtype=LOCALISED_FEATURE_DTYPE)
+            for name in FEATURE_DTYPE.names:
+                rows[name] = features[name]
+            for name in LOCALISATION_DTYPE.names:
+                rows[name] = localisations[name]
+            if(self.recentre_rois):
+                # Failed fits can end anywhere, their ROIs are kept as they are (zero offset).
+                offsets = np.column_stack((localisations['y_position'] - PIXEL_CENTRE - features['y'],
+                                           localisations['x_position'] - PIXEL_CENTRE - features['x']))
+                offsets[~localisations['fit_ok']] = 0
+                rois = recentre_rois(rois, offsets)
+        return rois, rows
 
-        # read image
-        image = skimage.io.imread(path)
-        for frame in range(0, image.shape[0]):
-            if(len(self.movie_emitter_list) < self.emitter_list_length): # specific movie length
-                # For each frame get location of peak intensity values.
-                # Get minimum value for threshold intensity using gaussian filters.
-                # Values above threshold will be classed as emitter locations.
-                singleFrame = image[frame, :, :]
-                Gauss1FilteredImage = gaussian_filter(
-                   singleFrame, sigma=self.GaussianFiltersigma1).astype(float)
-                Gauss2FilteredImage = gaussian_filter(
-                    singleFrame, sigma=self.GaussianFiltersigma2).astype(float)
-                DoGFilteredImage = Gauss1FilteredImage-Gauss2FilteredImage
-                MinValueLocalMax = np.std(DoGFilteredImage)*2
-                localpeaks = peak_local_max(
-                    DoGFilteredImage, threshold_abs=MinValueLocalMax)
-
-                # remove emitters close to edge region due to differing intensity values
-                markForDeletion = []
-                for i in range(0, localpeaks.shape[0]):
-                    if (localpeaks[i][0] <= (self.BorderRegion+1)) \
-                        or (localpeaks[i][0] >= singleFrame.shape[0]-(self.BorderRegion+1)) \
-                        or (localpeaks[i][1] <= (self.BorderRegion+1)) \
-                        or (localpeaks[i][1] >= singleFrame.shape[1]-(self.BorderRegion+1)):
-                            markForDeletion = np.append(markForDeletion, i)
-
-                markForDeletion = np.int_(markForDeletion)
-                localpeaks = np.delete(localpeaks, markForDeletion, axis=0)
-
-                # Extract the ROI - we know it is centered around the localpeaks[l,:] position, with radius ROIradius
-                for l in range(0, len(localpeaks)):
-                    ROI = singleFrame[localpeaks[l, 0]-self.ROIradius:localpeaks[l, 0]+self.ROIradius+1,
-                                      localpeaks[l, 1]-self.ROIradius:localpeaks[l, 1]+self.ROIradius+1]
-                    # Define image parameters, x,y inverse fourier magnitude, intensity.
-                    ROI_F = np.fft.fft2(ROI)
-                    xmagnitude = np.abs(ROI_F[0, 1])
-                    xmaginv = 1/xmagnitude
-                    ymagnitude = np.abs(ROI_F[1, 0])
-                    ymaginv = 1/ymagnitude
-                    maxIntensityvalue = 0
-
-                    # Check for ellipticity by comparing inverse Fourier magnitudes
-                    # Resulting ellipticity should be less than ellipticity_cval
-                    calculated_ellipticity = xmaginv - ymaginv
-
-                    self.total_emitters_processed += 1
-                    MinValueLocalMaxR = np.std(ROI)*self.edge_peak_threshold_value
-
-                    # Check for multiple emitter peaks in single image and on edges with specific edgevalue. 
-                    ROIpeaks = peak_local_max(ROI, threshold_abs = MinValueLocalMaxR)
-                    edgeValue = MinValueLocalMaxR
-
-                    maxIntensityvalue = np.sum(ROI)/((self.ROIradius*2 + 1)**2)
-
-                    # Check image intensity parameters with ideal image parameters and desired tiff file length.
-                    if(len(self.movie_emitter_list) < self.emitter_list_length): # specific movie length
-                        if(self.IntensityRange_median - self.IntensityRange_stddev < maxIntensityvalue and maxIntensityvalue <  self.IntensityRange_median + self.IntensityRange_stddev): #within specific intensity range
-                            if((np.all(ROI[:, 0] < edgeValue)) and (np.all(ROI[:, self.ROIradius*2] < edgeValue)) and (np.all(ROI[0, :] < edgeValue)) and (np.all(ROI[self.ROIradius*2, :] < edgeValue))):
-                                if(len(ROIpeaks) == 1): #amount of emitter peaks in ROI    
-                                    if(self.ellipticity_mean - self.ellipticity_stddev < calculated_ellipticity and calculated_ellipticity < self.ellipticity_mean + self.ellipticity_stddev):  
-                                        if(self.xinvmag_mean - self.xinvmag_stddev < xmaginv and xmaginv < self.xinvmag_mean + self.xinvmag_stddev):
-                                            if(self.yinvmag_mean - self.yinvmag_stddev < ymaginv and ymaginv < self.yinvmag_mean + self.yinvmag_stddev):
-                                                # if correct parameters adds to list
-                                                self.movie_emitter_list.append(ROI)
-                                                self.good_emitters_added += 1
-                                        #print(self.good_emitters_added)
-                                        # Stop appending if list length is reached
+    def add_to_list(self, path):
+        if(self.feature_cache is not None):
+            # Candidates of the whole movie come from the cache (detected and stored on first use),
+            # calibration and filtering are selections on the feature table.
+            features, rois, length = self._movie_features(path)
+            if(self.use_input_parameter_vals == False):
+                self.get_parameters_from_features(self.calibration_rows(features, length), path)
+            self.add_features_to_list(features, rois)
+            if(len(self.movie_emitter_list) == self.emitter_list_length):
+                print("Emitter list length reached!")
+            return
+
+        with TiffMovieReader(path) as movie:
+            # Frames detected during calibration, kept in single pass mode so they are not detected again.
+            cache = {} if self.single_pass else None
+            if(self.use_input_parameter_vals == False):
+                # If false updates parameters by
+                self._calibrate(movie, cache)
+
+            # read image, stop once the emitter list is full
+            framesRead = 0
+            for frame in range(0, len(movie)):
+                if(len(self.movie_emitter_list) >= self.emitter_list_length): # specific movie length
+                    break
+                if(cache is not None and frame in cache):
+                    features, rois = cache.pop(frame)
+                else:
+                    features, rois = self._frame_features(self._read_frame(movie, frame), frame)
+                    framesRead += 1
+                # Check image parameters against acceptance ranges and desired tiff file length.
+                self.add_features_to_list(features, rois)
+            self.frames_read += framesRead
+            print("Frames read:", framesRead, "of", len(movie))
         if(len(self.movie_emitter_list) == self.emitter_list_length):
                         print("Emitter list length reached!")
 
@@ -228,77 +390,149 @@ class EmitterMovie:
         # Saves in parent directory.
         print("\n Emitter list length: ",self.good_emitters_added)
         print("\n Acceptance ratio of emitters detected:", (self.good_emitters_added/self.total_emitters_processed)*100,"%")
-        movie_emitters_array = np.asarray(self.movie_emitter_list)
-        tifffile.imwrite(name, movie_emitters_array)
+        tifffile.imwrite(name, self.movie_emitter_list.rois)
         print("\n Tiff file created! \n")
 
+    def save_emitter_table(self, name):
+        # Save the features (and localisations) of the emitter list as CSV, one row per saved ROI.
+        metadata = self.movie_emitter_list.metadata
+        with open(name, 'w', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(metadata.dtype.names)
+            writer.writerows(metadata.tolist())
 
-if __name__ == "__main__":
-
-    # Acceptance data
-    median_intensity = 2504.0123456790125
-    std_dev_intensity = 882.0797299810998
-    xinvmag_mean = 2.4878015175981878e-05
-    xinvmag_std = 1.5717972575586092e-05
-    yinvmag_mean = 2.4031295141239076e-05
-    yinvmag_std = 1.5884859638799993e-05
-    mean_ellipticity = 8.467200347428055e-07
-    std_dev_ellipticity = 6.000592627336967e-06
 
-    movie_length = 1000 # Final filtered movie size. 
-    test_movie_length = 1000 # Test movie size from which acceptance values are calculated.
-        # If file is bad or settings are wrong will generate movies of lesser size than specified. 
+def movie_length(path):
+    # Amount of frames in a Tiff movie, without reading the pixel data.
+    with TiffMovieReader(path, use_memmap=False) as movie:
+        return len(movie)
 
-    GaussianFiltersigma1 = 0.01 # Gaussian blurring filter sigmas.
-    GaussianFiltersigma2 = 3
-    ROIradius = 4 # Generates ROI of (2*ROIradius + 1) ** 2.
-    BorderRegion = 20 # Specify amount of distance from edges where emitters will be discarded. 
-    edge_peak_threshold_value = 3 # Multiplier, specifies thresholf level in ROI to find secondary emitters.
-                                # Use lower value to be more selective. 
-    use_input_param_vals = False # If False, generates acceptance data from file, if True uses input data.
 
-    E7051 = EmitterMovie("525", GaussianFiltersigma1, GaussianFiltersigma2, ROIradius, BorderRegion, movie_length, test_movie_length, 
-                        edge_peak_threshold_value, use_input_param_vals, xinvmag_mean, xinvmag_std, yinvmag_mean, yinvmag_std, mean_ellipticity,
-                        std_dev_ellipticity, median_intensity, std_dev_intensity)
-    E7051.add_to_list('qdot_emitters/2022.06.08_wN2/Cheap_Objective_NA1.25/BO_605/BO_Qdots605nm_0.2nM_488nm_125mW_QuadFilter_50ms_f1000_1/BO_Qdots605nm_0.2nM_488nm_125mW_QuadFilter_50ms_f1000_1_MMStack_Default.ome.tif')
-    E7051.save_emitter_list("e605_1_filtered_1k_9x9_lp3_bo")  
+def _extract_chunk(movie, path, start, stop):
+    # Runs in a worker on a copy of movie, its profiler (if any) is returned to be merged by _collect_chunks.
+    if(movie.profiler is not None):
+        movie.profiler = StageProfiler()
+    features, rois = movie.extract_features(path, range(start, stop))
+    return features, rois, movie.profiler
 
- 
-
-    E7052 = EmitterMovie("525", GaussianFiltersigma1, GaussianFiltersigma2, ROIradius, BorderRegion, movie_length, test_movie_length, 
-                        edge_peak_threshold_value, use_input_param_vals, xinvmag_mean, xinvmag_std, yinvmag_mean, yinvmag_std, mean_ellipticity,
-                        std_dev_ellipticity, median_intensity, std_dev_intensity)
-    E7052.add_to_list("qdot_emitters/2022.06.08_wN2/Cheap_Objective_NA1.25/BO_655/BO_Qdot655nm_0.2nM_488nm_125mW_QuadFilter_50ms_f1000_1/BO_Qdot655nm_0.2nM_488nm_125mW_QuadFilter_50ms_f1000_1_MMStack_Default.ome.tif")
-    E7052.save_emitter_list("e655_1_filtered_1k_9x9_lp3_bo")  
 
+def _submit_chunks(executor, movie, path, chunk_size):
+    length = movie_length(path)
+    chunks = [range(start, min(start + chunk_size, length)) for start in range(0, length, chunk_size)]
+    return length, [(len(frames), executor.submit(_extract_chunk, movie, path, frames.start, frames.stop))
+                    for frames in chunks]
 
 
+def calibrated_chunks(movie, chunks, length, source=None):
     '''
-
-    E7051 = EmitterMovie("525", GaussianFiltersigma1, GaussianFiltersigma2, ROIradius, BorderRegion, movie_length, test_movie_length, 
-                        edge_peak_threshold_value, use_input_param_vals, xinvmag_mean, xinvmag_std, yinvmag_mean, yinvmag_std, mean_ellipticity,
-                        std_dev_ellipticity, median_intensity, std_dev_intensity)
-    E7051.add_to_list('qdot_emitters/2022.06.08_wN2/Expensive_Objective_NA_1.49/525/Qdots525nm_0.2nM_488nm_125mW_QuadFilter_50ms_f1000_1/Qdots525nm_0.2nM_488nm_125mW_QuadFilter_50ms_f1000_1_MMStack_Default.ome.tif')
-    E7051.save_emitter_list("e525_1_filtered_1k_9x9_lp3_go")  
-
- 
-
-    E7052 = EmitterMovie("525", GaussianFiltersigma1, GaussianFiltersigma2, ROIradius, BorderRegion, movie_length, test_movie_length, 
-                        edge_peak_threshold_value, use_input_param_vals, xinvmag_mean, xinvmag_std, yinvmag_mean, yinvmag_std, mean_ellipticity,
-                        std_dev_ellipticity, median_intensity, std_dev_intensity)
-    E7052.add_to_list("qdot_emitters/2022.06.08_wN2/Expensive_Objective_NA_1.49/605/Qdots605nm_0.2nM_488nm_125mW_QuadFilter_50ms_f1000_1/Qdots605nm_0.2nM_488nm_125mW_QuadFilter_50ms_f1000_1_MMStack_Default.ome.tif")
-    E7052.save_emitter_list("e605_1_filtered_1k_9x9_lp3_go")  
-
-    E7053 = EmitterMovie("525", GaussianFiltersigma1, GaussianFiltersigma2, ROIradius, BorderRegion, movie_length, test_movie_length, 
-                        edge_peak_threshold_value, use_input_param_vals, xinvmag_mean, xinvmag_std, yinvmag_mean, yinvmag_std, mean_ellipticity,
-                        std_dev_ellipticity, median_intensity, std_dev_intensity)
-    E7053.add_to_list("qdot_emitters/2022.06.08_wN2/Expensive_Objective_NA_1.49/655/Qdot655nm_0.2nM_488nm_125mW_QuadFilter_50ms_f1000_1/Qdot655nm_0.2nM_488nm_125mW_QuadFilter_50ms_f1000_1_MMStack_Default.ome.tif")
-    E7053.save_emitter_list("e655_1_filtered_1k_9x9_lp3_go")  
-
-    E7054 = EmitterMovie("525", GaussianFiltersigma1, GaussianFiltersigma2, ROIradius, BorderRegion, movie_length, test_movie_length, 
-                        edge_peak_threshold_value, use_input_param_vals, xinvmag_mean, xinvmag_std, yinvmag_mean, yinvmag_std, mean_ellipticity,
-                        std_dev_ellipticity, median_intensity, std_dev_intensity)
-    E7054.add_to_list("qdot_emitters/2022.06.08_wN2/Expensive_Objective_NA_1.49/705/Qdots705nm_0.2nM_488nm_125mW_QuadFilter_50ms_f1000_1/Qdots705nm_0.2nM_488nm_125mW_QuadFilter_50ms_f1000_1_MMStack_Default.ome.tif")
-    E7054.save_emitter_list("e705_1_filtered_1k_9x9_lp3_go")  
+    Pass on (features, rois) of consecutive chunks of a movie of length frames (in frame order, e.g. of
+    detect_chunks) once movie has acceptance ranges, calibrating it the same way add_to_list does.
+    With use_input_parameter_vals False, chunks are held back until enough calibration emitters have been seen,
+    then acceptance ranges are inferred and the held chunks are passed on as one.
+    Calibration frames spread over the movie ('stride' or 'random') need all chunks first.
+    source is the movie recorded with the calibration emitters.
+    '''
+    calibrating = movie.use_input_parameter_vals == False
+    heldFeatures, heldRois = [], []
+    for features, rois in chunks:
+        if(calibrating):
+            heldFeatures.append(features)
+            heldRois.append(rois)
+            if(movie.calibration_sampling != 'first'):
+                continue
+            movie.add_calibration_features(features, source)
+            if(movie.test_emitter_list < movie.test_emitter_list_length):
+                continue
+            calibrating = False
+            movie._set_parameters()
+            features, rois = np.concatenate(heldFeatures), np.concatenate(heldRois)
+        yield features, rois
+    if(calibrating and heldFeatures): # all frames needed for calibration
+        features, rois = np.concatenate(heldFeatures), np.concatenate(heldRois)
+        if(movie.calibration_sampling != 'first'):
+            movie.add_calibration_features(movie.calibration_rows(features, length), source)
+        movie._set_parameters()
+        yield features, rois
+
+
+def _detect_stack(movie, stack, frames):
+    # Runs in a detection thread of detect_chunks on a copy of movie, its profiler (if any) is merged by detect_chunks.
+    features, rois = movie._chunk_features(stack, frames)
+    return features, rois, movie.profiler
+
+
+def detect_chunks(movie, reader, chunk_frames=32, workers=None):
+    '''
+    (features, rois) of consecutive chunks of chunk_frames frames of an open movie (a movieReader.TiffMovieReader),
+    in frame order. Stacks are read in order in the calling thread and detected by workers threads (default: all
+    cores) ahead of the consumer, every chunk on a copy of movie with its own profiler (if movie has one) which is
+    merged into movie's profiler in the calling thread. The frames read are added to movie.frames_read.
     '''
+    workers = workers or os.cpu_count()
+    length = len(reader)
+    chunks = deque(range(start, min(start + chunk_frames, length)) for start in range(0, length, chunk_frames))
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        pending = deque()
+        while(chunks or pending):
+            # Keep every detection thread busy (and one chunk queued) while the consumer works.
+            while(chunks and len(pending) <= workers):
+                frames = chunks.popleft()
+                with timed(movie.profiler, 'tiff_read', len(frames)):
+                    stack = reader.read_range(frames.start, frames.stop)
+                chunkMovie = copy.copy(movie)
+                if(movie.profiler is not None):
+                    chunkMovie.profiler = StageProfiler()
+                pending.append((len(frames), executor.submit(_detect_stack, chunkMovie, stack, frames)))
+            chunkLength, future = pending.popleft()
+            features, rois, profiler = future.result()
+            if(profiler is not None):
+                movie.profiler.merge(profiler)
+            movie.frames_read += chunkLength
+            yield features, rois
+
+
+def _collect_chunks(movie, path, length, futures):
+    # Combine chunk results in frame order, the same way add_to_list consumes frames (see calibrated_chunks).
+    framesRead = 0
+
+    def results():
+        nonlocal framesRead
+        for chunkLength, future in futures:
+            if(len(movie.movie_emitter_list) >= movie.emitter_list_length):
+                return
+            features, rois, profiler = future.result()
+            if(profiler is not None):
+                movie.profiler.merge(profiler)
+            framesRead += chunkLength
+            yield features, rois
+
+    for features, rois in calibrated_chunks(movie, results(), length, path):
+        movie.add_features_to_list(features, rois)
+    for _, future in futures:
+        future.cancel()
+    movie.frames_read += framesRead
+    print("Frames read:", framesRead, "of", length)
+    if(len(movie.movie_emitter_list) == movie.emitter_list_length):
+        print("Emitter list length reached!")
+
+
+def process_movies(jobs, max_workers=None, chunk_size=50):
+    '''
+    Parallel version of EmitterMovie.add_to_list for several movies.
+    jobs is a list of (EmitterMovie, path) pairs, a movie may appear more than once to add several files.
+    Frames of all movies are split in chunks of chunk_size frames and detected in a process pool
+    of max_workers processes (default: all cores). Chunk results are combined in frame order, so every
+    EmitterMovie ends up with the same emitter list as with serial add_to_list calls.
+    Chunks which are not needed any more once a movie's emitter list is full are cancelled.
+    '''
+    with ProcessPoolExecutor(max_workers=max_workers or os.cpu_count()) as executor:
+        submitted = [(movie, path) + _submit_chunks(executor, movie, path, chunk_size) for movie, path in jobs]
+        for movie, path, length, futures in submitted:
+            _collect_chunks(movie, path, length, futures)
+    return [movie for movie, _ in jobs]
 
+
+if __name__ == "__main__":
+    # Jobs are listed in a manifest, see batchRunner.py.
+    from batchRunner import main
+    raise SystemExit(main())
@@ -1,32 +1,86 @@
-import matplotlib.pyplot as plt
 import numpy as np
-import skimage.io
-from sympy import imageset
 import tifffile
 
+from movieReader import TiffMovieReader
+
+
+NORMALISATION_MODES = ('spectral', 'frobenius', 'max', 'zscore')
+
+
+def spectral_norms(frames, method='svd'):
+    # Largest singular value of every frame of a (N, h, w) stack.
+    # 'svd' uses stacked singular value decompositions, equal to np.linalg.norm(frame, 2) per frame.
+    # 'eigh' takes the square root of the largest eigenvalue of frame.T @ frame (stacked symmetric
+    # eigenvalue solver), faster and equal to 'svd' to floating point precision.
+    frames = np.asarray(frames, dtype=float)
+    if(method == 'svd'):
+        return np.linalg.norm(frames, 2, axis=(1, 2))
+    if(method == 'eigh'):
+        gram = np.einsum('nji,njk->nik', frames, frames, optimize=True)
+        return np.sqrt(np.maximum(np.linalg.eigvalsh(gram)[:, -1], 0))
+    raise ValueError("method must be 'svd' or 'eigh'")
+
+
+def frame_norms(frames, mode='spectral', method='svd'):
+    # Norm of every frame of a stack used for normalisation:
+    # 'spectral' (2-norm, largest singular value), 'frobenius', 'max' (largest absolute value)
+    # or 'zscore' (standard deviation of the frame).
+    frames = np.asarray(frames, dtype=float)
+    if(mode == 'spectral'):
+        return spectral_norms(frames, method)
+    if(mode == 'frobenius'):
+        return np.sqrt(np.sum(frames**2, axis=(1, 2)))
+    if(mode == 'max'):
+        return np.max(np.abs(frames), axis=(1, 2))
+    if(mode == 'zscore'):
+        return np.std(frames, axis=(1, 2))
+    raise ValueError("mode must be one of " + ", ".join(NORMALISATION_MODES))
+
+
+def normalize_frames(frames, mode='spectral', method='svd'):
+    # Center every frame of a (N, h, w) stack to mean 0 and divide it by its norm, see frame_norms.
+    # With the default spectral mode this is what scaledEmitterMovie always did frame by frame.
+    frames = frames - np.mean(frames, axis=(1, 2), keepdims=True)
+    return frames/frame_norms(frames, mode, method)[:, np.newaxis, np.newaxis]
+
+
 class scaledEmitterMovie:
     '''
     This program splices and scales tiff single emitter files to one movie of desired length for input to a neural network.
     It scales by centering each emitter to have mean 0 and taking the euclidian 2 norm.
     Create scaledEmitterMovie object with desired length and use add_to_movie to add emitter files.
     Use save_movie to save file.
+
+    Input files are read lazily: add_to_movie only counts the frames of a file (files beyond MovieLength frames
+    are skipped), save_movie opens every file while it reads its frames in chunks of chunk_size,
+    stops reading at MovieLength frames and writes scaled frames straight to the output file,
+    so memory use does not depend on the amount or size of input files.
+    Normalisation selects another per frame norm instead of the 2-norm, see frame_norms.
     '''
-    def __init__(self, MovieLength):
+    def __init__(self, MovieLength, chunk_size=4096, normalisation='spectral', norm_method='svd'):
         self.MovieLength = MovieLength
-        self.imageset = []
-        self.imageset = np.array(self.imageset)
-        self.Movie = []
+        self.chunk_size = chunk_size
+        self.normalisation = normalisation # 'spectral', 'frobenius', 'max' or 'zscore', see frame_norms
+        self.norm_method = norm_method # 'svd' or 'eigh' for the spectral norm
+        self.inputs = [] # (path, amount of frames used, frame shape) of every input file
 
     def add_to_movie(self, folder_path):
-        if(len(self.imageset) == 0 ): 
-            imagesetFile = skimage.io.imread(folder_path)
-            imagesetFile = np.array(imagesetFile)
-            self.imageset = imagesetFile
-        else:
-            imagesetFileNew = skimage.io.imread(folder_path) 
-            imagesetFileNew = np.array(imagesetFileNew)
-            self.imageset = np.vstack((self.imageset, imagesetFileNew))
-    
+        # Files are only opened to count their frames, and not at all once the movie is full.
+        available = self.MovieLength - sum(frames for _, frames, _ in self.inputs)
+        if(available <= 0):
+            return
+        with TiffMovieReader(folder_path, use_memmap=False) as reader:
+            self.inputs.append((folder_path, min(len(reader), available), reader.shape[1:]))
+
+    @property
+    def imageset(self):
+        # All frames used for the movie in one array (reads them into memory).
+        stacks = []
+        for path, frames, _ in self.inputs:
+            with TiffMovieReader(path) as reader:
+                stacks.append(np.array(reader.read_range(0, frames)))
+        return np.concatenate(stacks)
+
     def normalize_2d(self, matrix):
         # Only this is changed to use 2-norm put 2 instead of 1
         norm = np.linalg.norm(matrix, 2)
@@ -34,17 +88,23 @@ class scaledEmitterMovie:
         matrix = matrix/norm  
         return matrix
 
+    def scale_frames(self, frames):
+        # Center every frame of a stack to mean 0 and divide it by its norm (by default the 2-norm).
+        return normalize_frames(frames, self.normalisation, self.norm_method)
+
+    def _scaled_frames(self):
+        for path, frames, _ in self.inputs:
+            with TiffMovieReader(path) as reader:
+                for start in range(0, frames, self.chunk_size):
+                    for singleFrame in self.scale_frames(reader.read_range(start, min(start + self.chunk_size, frames))):
+                        yield singleFrame
+
     def save_movie(self, name):
-        for i in range(self.MovieLength): # change number to open desired amount of emitters   
-            singleFrame = self.imageset[i,:,:]
-            #create function to center data
-            center_function = lambda x: x - x.mean()
-            #apply function to original NumPy array
-            singleFrame = center_function(singleFrame)
-            singleFrame = self.normalize_2d(singleFrame)
-            self.Movie.append(singleFrame)     
-        frames = np.array(self.Movie)
-        tifffile.imwrite(name, frames)
+        length = sum(frames for _, frames, _ in self.inputs)
+        if(length < self.MovieLength):
+            print("Only", length, "frames available!")
+        frameShape = self.inputs[0][2]
+        tifffile.imwrite(name, data=self._scaled_frames(), shape=(length,) + frameShape, dtype=np.float64)
         print("tiff file created!")
 
 
@@ -0,0 +1,100 @@
+from contextlib import contextmanager, nullcontext
+import csv
+import json
+import time
+
+import numpy as np
+
+
+# Processing stages of EmitterMovie, in pipeline order.
+STAGES = ('tiff_read', 'gaussian_filter', 'peak_finding', 'border_filter', 'roi_gather', 'roi_features', 'peak_test',
+          'acceptance', 'localisation')
+# Acceptance criteria, see EmitterMovie.acceptance_criteria.
+CRITERIA = ('intensity', 'edge', 'multi_peak', 'ellipticity', 'xinvmag', 'yinvmag')
+
+
+class StageProfiler:
+    '''
+    Opt-in wall time, call and item counters per processing stage and rejection counts per acceptance criterion.
+    Stage times are exclusive: time spent in a stage nested in another one (the peak test within ROI features)
+    only counts for the nested stage.
+    Items are what a stage produced or handled: frames read or filtered, peaks found, candidates kept by the
+    border filter, ROIs gathered, measured or tested, candidates checked for acceptance and emitters localised.
+    Candidates are those processed for acceptance, passed those meeting all criteria (a few more than are added
+    when the emitter list fills up within a frame). A candidate failing several criteria counts as rejected by each.
+    Memory-mapped movies are read lazily, so their read time mostly shows up in the first stage using the frames.
+
+    Pass a StageProfiler as profiler of an EmitterMovie, then use report or save (JSON or CSV) after processing.
+    Profilers of parallel workers are combined with merge.
+    '''
+    def __init__(self):
+        self.seconds = dict.fromkeys(STAGES, 0.0)
+        self.calls = dict.fromkeys(STAGES, 0)
+        self.items = dict.fromkeys(STAGES, 0)
+        self.candidates = 0
+        self.passed = 0
+        self.rejected = dict.fromkeys(CRITERIA, 0)
+        self._nested = [] # time of stages nested in each running stage
+
+    @contextmanager
+    def stage(self, name, items=0):
+        self._nested.append(0.0)
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            self.seconds[name] += elapsed - self._nested.pop()
+            if(self._nested):
+                self._nested[-1] += elapsed
+            self.calls[name] += 1
+            self.items[name] += items
+
+    def add_items(self, name, items):
+        self.items[name] += int(items)
+
+    def add_rejections(self, criteria):
+        # criteria: {criterion: boolean array of candidates passing it}.
+        passed = np.logical_and.reduce(list(criteria.values()))
+        self.candidates += len(passed)
+        self.passed += int(np.count_nonzero(passed))
+        for name, passing in criteria.items():
+            self.rejected[name] += int(np.count_nonzero(~passing))
+
+    def merge(self, other):
+        for name in STAGES:
+            self.seconds[name] += other.seconds[name]
+            self.calls[name] += other.calls[name]
+            self.items[name] += other.items[name]
+        for name in CRITERIA:
+            self.rejected[name] += other.rejected[name]
+        self.candidates += other.candidates
+        self.passed += other.passed
+
+    def report(self):
+        return {'stages': {name: {'seconds': self.seconds[name], 'calls': self.calls[name], 'items': self.items[name]}
+                           for name in STAGES},
+                'candidates': self.candidates, 'passed': self.passed, 'rejected': dict(self.rejected)}
+
+    def save(self, path):
+        # Report as JSON (.json) or CSV with one row per stage and per criterion.
+        report = self.report()
+        with open(path, 'w', newline='') as f:
+            if(path.endswith('.json')):
+                json.dump(report, f, indent=1)
+                return
+            writer = csv.writer(f)
+            writer.writerow(('kind', 'name', 'seconds', 'calls', 'count'))
+            for name, stage in report['stages'].items():
+                writer.writerow(('stage', name, stage['seconds'], stage['calls'], stage['items']))
+            writer.writerow(('acceptance', 'candidates', '', '', report['candidates']))
+            writer.writerow(('acceptance', 'passed', '', '', report['passed']))
+            for name, count in report['rejected'].items():
+                writer.writerow(('rejected', name, '', '', count))
+
+
+def timed(profiler, name, items=0):
+    # profiler.stage(name, items), or a no-op when profiling is off (profiler None).
+    if(profiler is None):
+        return nullcontext()
+    return profiler.stage(name, items)
@@ -0,0 +1,76 @@
+'''
+Synthetic quantum dot movies for benchmarks and checks without microscope data.
+Every frame has a background with Gaussian PSF emitters at random positions, Poisson shot noise and
+Gaussian read noise, written as a multi-page Tiff (one uint16 page per frame, like the microscope movies).
+'''
+import sys
+
+import numpy as np
+import tifffile
+
+from emitterLocalisation import PIXEL_CENTRE
+
+
+# Ground truth of every emitter, one row per emitter. Positions are pixel coordinates, see
+# emitterLocalisation.PIXEL_CENTRE, so they compare directly with localised positions.
+EMITTER_DTYPE = np.dtype([('frame', np.int64), ('y', np.float64), ('x', np.float64),
+                          ('sigma_y', np.float64), ('sigma_x', np.float64), ('photons', np.float64)])
+
+
+def synthetic_frames(frames=100, size=256, density=40, intensity=(800, 3000), sigma=(1.0, 1.8), ellipticity=0.1,
+                     background=500, noise=30, shot_noise=True, seed=0):
+    '''
+    Generator of (frame, emitters) pairs: a (size, size) uint16 frame and the EMITTER_DTYPE rows of its emitters.
+    density is the mean amount of emitters per frame (Poisson distributed), intensity the range of peak
+    amplitudes (counts above background) and sigma the range of PSF widths in pixels.
+    Ellipticity makes PSFs elliptical: sigma_x = sigma*(1 + e) and sigma_y = sigma*(1 - e) with e uniform
+    in [-ellipticity, ellipticity].
+    background is the mean background level, noise the standard deviation of Gaussian read noise,
+    and shot_noise adds Poisson noise to background and emitters.
+    '''
+    rng = np.random.default_rng(seed)
+    radius = int(np.ceil(4*sigma[1]*(1 + ellipticity)))
+    offsets = np.arange(-radius, radius + 1)
+    for frame in range(frames):
+        amount = rng.poisson(density)
+        emitters = np.zeros(amount, dtype=EMITTER_DTYPE)
+        emitters['frame'] = frame
+        emitters['y'], emitters['x'] = rng.uniform(0, size, (2, amount)) - 0.5 + PIXEL_CENTRE # anywhere in the frame
+        widths = rng.uniform(*sigma, amount)
+        e = rng.uniform(-ellipticity, ellipticity, amount)
+        emitters['sigma_y'], emitters['sigma_x'] = widths*(1 - e), widths*(1 + e)
+        amplitude = rng.uniform(*intensity, amount)
+        emitters['photons'] = 2*np.pi*amplitude*emitters['sigma_y']*emitters['sigma_x']
+
+        # Each emitter is drawn in a window of pixels around the pixel it is in, all emitters at once.
+        y = np.rint(emitters['y'] - PIXEL_CENTRE).astype(np.int64)[:, np.newaxis, np.newaxis] + offsets[:, np.newaxis]
+        x = np.rint(emitters['x'] - PIXEL_CENTRE).astype(np.int64)[:, np.newaxis, np.newaxis] + offsets
+        y, x = np.broadcast_arrays(y, x)
+        dy = (y + PIXEL_CENTRE - emitters['y'][:, np.newaxis, np.newaxis])/emitters['sigma_y'][:, np.newaxis, np.newaxis]
+        dx = (x + PIXEL_CENTRE - emitters['x'][:, np.newaxis, np.newaxis])/emitters['sigma_x'][:, np.newaxis, np.newaxis]
+        psf = amplitude[:, np.newaxis, np.newaxis]*np.exp(-0.5*(dy**2 + dx**2))
+        inside = (y >= 0) & (y < size) & (x >= 0) & (x < size)
+        image = np.full((size, size), float(background))
+        np.add.at(image, (y[inside], x[inside]), psf[inside])
+
+        if(shot_noise):
+            image = rng.poisson(image).astype(float)
+        image += rng.normal(0, noise, image.shape)
+        yield np.clip(np.rint(image), 0, 65535).astype(np.uint16), emitters
+
+
+def write_synthetic_movie(path, frames=100, size=256, **settings):
+    # Write a synthetic movie (see synthetic_frames for the settings) and return the ground truth of its emitters.
+    # Emitter positions are pixel coordinates, see emitterLocalisation.PIXEL_CENTRE.
+    truth = [np.zeros(0, dtype=EMITTER_DTYPE)]
+    with tifffile.TiffWriter(path) as tif:
+        for frame, emitters in synthetic_frames(frames, size, **settings):
+            tif.write(frame, contiguous=True)
+            truth.append(emitters)
+    return np.concatenate(truth)
+
+
+if __name__ == "__main__":
+    # python syntheticMovies.py movie.tif [frames] [size]
+    write_synthetic_movie(sys.argv[1], int(sys.argv[2]) if len(sys.argv) > 2 else 100,
+                          int(sys.argv[3]) if len(sys.argv) > 3 else 256)